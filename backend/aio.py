@@ -0,0 +1,127 @@
+"""
+Asyncio interface for requesting menus.
+
+The pages are downloaded with a limited number of concurrent requests per site, and
+parsed in a small thread pool, so many restaurants can be resolved at the same time
+from one event loop:
+
+    menus = asyncio.run(aio.get_menus(["glaze", "nordicforum"]))
+
+The downloads still use the (blocking) shared session, as it handles the Cloudflare
+challenges, so each download in progress occupies a thread in the download pool.
+Concurrent requests for the same restaurant and day share one download and parse.
+"""
+import asyncio
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import main
+import parser as ps
+import registry
+import session
+import storage
+
+# downloads in total (the downloads per site are limited to session.HOST_CONCURRENCY)
+DOWNLOAD_THREADS = int(os.environ.get("MENU_DOWNLOAD_THREADS", 8))
+PARSE_THREADS = int(os.environ.get("MENU_PARSE_THREADS", 2))
+
+_DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS, thread_name_prefix="menu-download")
+_PARSE_POOL = ThreadPoolExecutor(max_workers=PARSE_THREADS, thread_name_prefix="menu-parse")
+
+# semaphores and tasks belong to an event loop, so keep them per loop
+_SEMAPHORES = weakref.WeakKeyDictionary()
+_FLIGHTS = weakref.WeakKeyDictionary()
+
+
+def _site_semaphore(url: str) -> asyncio.Semaphore:
+    """
+    The semaphore limiting the concurrent downloads from the site of the url
+
+    Keeps the downloads waiting for their turn in the session from filling the download pool.
+    """
+    semaphores = _SEMAPHORES.setdefault(asyncio.get_running_loop(), {})
+    site = session.get_site(url)
+    if site not in semaphores:
+        semaphores[site] = asyncio.Semaphore(session.HOST_CONCURRENCY)
+    return semaphores[site]
+
+
+async def fetch_page(url: str) -> tuple:
+    """
+    Download a page
+
+    Returns the page text, or the exception raised while downloading it, together with
+    the seconds the download took.
+    """
+    async with _site_semaphore(url):
+        start = time.perf_counter()
+        try:
+            page = await asyncio.get_running_loop().run_in_executor(_DOWNLOAD_POOL, ps.get_page, url)
+        except Exception as err:  # pylint: disable=broad-except
+            page = err
+        return page, time.perf_counter() - start
+
+
+def _parse(name: str, restaurant_data: dict, pages: dict) -> dict:
+    """
+    Run the parser of a restaurant on already downloaded pages, storing the result
+    """
+    with ps.prefetched(pages):
+        return main.fetch_restaurant(name, restaurant_data)
+
+
+async def get_restaurant(name: str, restaurant_data: dict = None) -> dict:
+    """
+    Request the menu of a restaurant
+
+    Returns an empty dict if there is no parser for the restaurant.
+    """
+    restaurant_data = restaurant_data or registry.get().restaurants
+    if name not in restaurant_data or not main.find_parser(name, restaurant_data):
+        return {}
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(_PARSE_POOL, main.cached_menu, name, restaurant_data)
+    if data is not None:
+        return data
+    flights = _FLIGHTS.setdefault(loop, {})
+    key = (name, storage.today())
+    if key not in flights:
+        flights[key] = loop.create_task(_download_and_parse(name, restaurant_data))
+        flights[key].add_done_callback(lambda _: flights.pop(key, None))
+    # a caller giving up (e.g. on timeout) must not cancel the fetch for the others
+    return dict(await asyncio.shield(flights[key]))
+
+
+async def _download_and_parse(name: str, restaurant_data: dict) -> dict:
+    """
+    Download the page of a restaurant and run its parser on it
+    """
+    url = restaurant_data[name]["menuUrl"]
+    pages = {url: await fetch_page(url)}
+    return await asyncio.get_running_loop().run_in_executor(_PARSE_POOL, _parse, name, restaurant_data, pages)
+
+
+async def _get_or_timeout(name: str, restaurant_data: dict, timeout: float) -> dict:
+    """
+    Request the menu of a restaurant, with an empty menu if it takes too long
+    """
+    try:
+        return await asyncio.wait_for(get_restaurant(name, restaurant_data), timeout)
+    except asyncio.TimeoutError:
+        return dict(ps.restaurant_info(restaurant_data[name]), menu=[])
+
+
+async def get_menus(names, restaurant_data: dict = None, timeout: float = main.TIMEOUT) -> dict:
+    """
+    Request the menus of several restaurants concurrently
+
+    Unknown restaurants are skipped. The menus are keyed by identifier, in the order of names.
+    """
+    restaurant_data = restaurant_data or registry.get().restaurants
+    names = [
+        name for name in dict.fromkeys(names)
+        if name in restaurant_data and main.find_parser(name, restaurant_data)
+    ]
+    menus = await asyncio.gather(*(_get_or_timeout(name, restaurant_data, timeout) for name in names))
+    return dict(zip(names, menus))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the restaurant parsers, using saved pages instead of the live sites.
+
+Usage:
+    python3 benchmarks/bench.py [-n REPEATS] [--save FILE] [--compare FILE]
+    python3 benchmarks/bench.py --record
+
+The page of a restaurant is read from fixtures/<identifier>.html (or .xml), or from the
+page of its parser (e.g. fixtures/kvartersmenyn.html). The parsers are run for a fixed
+day, so the results do not depend on the day the benchmarks are run: the day the pages
+were recorded with --record (listed in fixtures/recorded.json), or BENCH_DAY for the
+hand-made pages. In those, @WEEK@ is replaced by the week number of the day and @DATE0@
+to @DATE4@ by the dates of the weekdays of its week (e.g. "Tisdag 13 oktober").
+
+For each restaurant the parse time (min and median over the repeats), the peak memory
+use and the memory blocks (and their size) still allocated after the parse are reported,
+followed by the total time of main.activate_parsers for all restaurants. --record replaces the pages with the
+live ones for the restaurants in restaurants.json (only those downloaded with status 200).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+RECORDED_FILE = os.path.join(FIXTURE_DIR, "recorded.json")
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+# keep the benchmarks away from the real menu storage
+os.environ["MENU_DB"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+
+import main  # pylint: disable=wrong-import-position
+import parser as ps  # pylint: disable=wrong-import-position
+import registry  # pylint: disable=wrong-import-position
+import session  # pylint: disable=wrong-import-position
+import storage  # pylint: disable=wrong-import-position
+
+# a tuesday, so that there are menus both before and after it in the week
+BENCH_DAY = date(2026, 10, 13)
+
+
+def restaurant_data() -> dict:
+    """
+    Restaurant data for every restaurant with a parser
+
+    Restaurants missing in restaurants.json get made up data.
+    """
+    data = {}
+    for name in main.MAPPER:
+        data[name] = {
+            "identifier": name,
+            "name": name,
+            "region": "",
+            "homepage": "",
+            "gmaps": "",
+            "menuUrl": f"https://fixtures.invalid/{name}",
+        }
+    data.update(registry.get().restaurants)
+    return {name: entry for name, entry in data.items() if main.find_parser(name, data)}
+
+
+def recorded_days() -> dict:
+    """
+    The day each recorded page was downloaded, keyed by restaurant
+    """
+    if not os.path.exists(RECORDED_FILE):
+        return {}
+    with open(RECORDED_FILE) as infile:
+        return {name: date.fromisoformat(day) for name, day in json.load(infile).items()}
+
+
+def find_fixture(name: str, parser_name: str) -> str:
+    """
+    Find the saved page for a restaurant
+
+    Returns None if there is no page, e.g. for parsers that do not download anything.
+    """
+    for base in (name, parser_name.replace("parse_", "")):
+        for ext in (".html", ".xml"):
+            path = os.path.join(FIXTURE_DIR, base + ext)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def load_fixture(path: str, dates: ps.DateContext) -> str:
+    """
+    Read a saved page, filling in the week and dates of the date context
+    """
+    with open(path, encoding="utf-8") as infile:
+        text = infile.read()
+    text = text.replace("@WEEK@", str(dates.week))
+    for wdigit in range(5):
+        day = dates.date_of(wdigit)
+        text = text.replace(
+            f"@DATE{wdigit}@", f"{dates.weekday(wdigit=wdigit).capitalize()} {day.day} {dates.month}"
+        )
+    return text
+
+
+def install_pages(data: dict, dates: ps.DateContext):
+    """
+    Replace the page downloads with the saved pages
+    """
+    pages = {}
+    for name, entry in data.items():
+        path = find_fixture(name, main.find_parser(name, data).__name__)
+        if path:
+            pages[entry["menuUrl"]] = load_fixture(path, dates)
+
+    def get_page(url: str) -> str:
+        if url not in pages:
+            raise IOError("Url " + str(url) + " has no saved page")
+        return pages[url]
+
+    ps.get_page = get_page
+
+
+def count_dishes(data: dict) -> int:
+    """
+    Number of dishes found, for all days if available
+    """
+    if "week" in data:
+        return sum(len(menu) for menu in data["week"].values())
+    return len(data["menu"])
+
+
+def bench_restaurant(name: str, data: dict, repeats: int, dates: ps.DateContext) -> dict:
+    """
+    Measure the parser of one restaurant
+    """
+    parser = main.find_parser(name, data)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parser(data[name], dates)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = parser(data[name], dates)
+    allocated, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    return {
+        "min_ms": min(times) * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "peak_kib": peak / 1024,
+        "allocated_kib": allocated / 1024,
+        "allocated_blocks": blocks,
+        "dishes": count_dishes(result),
+    }
+
+
+def bench_activate(data: dict, repeats: int, dates: ps.DateContext) -> dict:
+    """
+    Measure main.activate_parsers for all restaurants, without any stored menus
+
+    The failures and circuits are cleared as well, so that every run calls all parsers.
+    """
+    times = []
+    for _ in range(repeats):
+        with storage.connect() as conn:
+            for table in ("menus", "failures", "circuits", "fragments"):
+                conn.execute(f"DELETE FROM {table}")
+        start = time.perf_counter()
+        main.activate_parsers(list(data), data, dates)
+        times.append(time.perf_counter() - start)
+    return {"min_ms": min(times) * 1000, "median_ms": statistics.median(times) * 1000}
+
+
+def run(repeats: int) -> dict:
+    """
+    Run all benchmarks
+    """
+    data = restaurant_data()
+    recorded = recorded_days()
+    day = max(recorded.values(), default=BENCH_DAY)
+    dates = ps.DateContext.for_day(day)
+    install_pages(data, dates)
+    results = {"day": day.isoformat(), "restaurants": {}, "activate_parsers": None}
+    for name in data:
+        own_day = recorded.get(name, day)
+        if own_day != day:
+            sys.stderr.write(f"W: {name} was recorded on {own_day}, activate_parsers runs for {day}\n")
+        results["restaurants"][name] = bench_restaurant(name, data, repeats, ps.DateContext.for_day(own_day))
+    results["activate_parsers"] = bench_activate(data, repeats, dates)
+    return results
+
+
+def change(new: float, old: float) -> str:
+    """
+    Relative change as text
+    """
+    if not old:
+        return ""
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def print_results(results: dict, previous: dict = None):
+    """
+    Print the results as a table, compared to previous results if given
+    """
+    previous = previous or {"restaurants": {}, "activate_parsers": {}}
+    print(
+        f"{'restaurant':<16}{'min ms':>9}{'median ms':>11}{'':>7}{'peak KiB':>10}{'':>7}"
+        f"{'alloc KiB':>10}{'blocks':>8}{'':>7}{'dishes':>8}"
+    )
+    for name, res in results["restaurants"].items():
+        old = previous["restaurants"].get(name, {})
+        print(
+            f"{name:<16}{res['min_ms']:>9.2f}{res['median_ms']:>11.2f}"
+            f"{change(res['median_ms'], old.get('median_ms')):>7}"
+            f"{res['peak_kib']:>10.0f}{change(res['peak_kib'], old.get('peak_kib')):>7}"
+            f"{res['allocated_kib']:>10.0f}{res['allocated_blocks']:>8}"
+            f"{change(res['allocated_blocks'], old.get('allocated_blocks')):>7}{res['dishes']:>8}"
+        )
+    total = results["activate_parsers"]
+    old = previous.get("activate_parsers") or {}
+    print(
+        f"{'activate_parsers':<16}{total['min_ms']:>9.2f}{total['median_ms']:>11.2f}"
+        f"{change(total['median_ms'], old.get('median_ms')):>7}"
+    )
+
+
+def record():
+    """
+    Save the live pages of the restaurants in restaurants.json as fixtures
+
+    The day of the download is saved in recorded.json, so the pages are parsed for that day.
+    """
+    recorded = {name: day.isoformat() for name, day in recorded_days().items()}
+    for name, entry in registry.get().restaurants.items():
+        try:
+            page_req = session.get(entry["menuUrl"])
+        except IOError as err:
+            sys.stderr.write(f"E in {name}: {err}\n")
+            continue
+        # e.g. a Cloudflare challenge, which is not the page to benchmark
+        if page_req.status_code != 200:
+            sys.stderr.write(f"E in {name}: status {page_req.status_code}, not saved\n")
+            continue
+        ext = ".xml" if "xml" in page_req.headers.get("Content-Type", "") else ".html"
+        with open(os.path.join(FIXTURE_DIR, name + ext), "w", encoding="utf-8") as outfile:
+            outfile.write(page_req.text)
+        recorded[name] = storage.today().isoformat()
+        sys.stderr.write(f"{name}: {len(page_req.text)} characters\n")
+    with open(RECORDED_FILE, "w") as outfile:
+        json.dump(recorded, outfile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    ARGS = argparse.ArgumentParser(description="Benchmark the restaurant parsers on saved pages")
+    ARGS.add_argument("-n", "--repeats", type=int, default=20, help="runs per benchmark (default 20)")
+    ARGS.add_argument("--save", help="save the results as json to this file")
+    ARGS.add_argument("--compare", help="compare with results saved by --save")
+    ARGS.add_argument("--record", action="store_true", help="save the live pages as fixtures")
+    OPTIONS = ARGS.parse_args()
+
+    if OPTIONS.record:
+        record()
+        sys.exit()
+
+    RESULTS = run(OPTIONS.repeats)
+    PREVIOUS = None
+    if OPTIONS.compare:
+        with open(OPTIONS.compare) as infile:
+            PREVIOUS = json.load(infile)
+    if PREVIOUS and PREVIOUS.get("day") != RESULTS["day"]:
+        sys.stderr.write(f"W: comparing results for {RESULTS['day']} with results for {PREVIOUS.get('day')}\n")
+    print_results(RESULTS, PREVIOUS)
+    if OPTIONS.save:
+        with open(OPTIONS.save, "w") as outfile:
+            json.dump(RESULTS, outfile, indent=2)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Check the startup time of the backend against a budget.
+
+Usage:
+    python3 benchmarks/import_budget.py [-n RUNS] [--main-ms MS] [--flask-ms MS]
+
+Each check runs in a new interpreter, and the fastest of the runs is used. The time to
+import main (as in every CLI run) and flask_app (as in every gunicorn worker) must be
+within the budgets, and the scraping dependencies must not be imported by the import,
+the usage text or the listing of the restaurants. Exits with status 1 if any check fails.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# only needed once a restaurant is fetched
+HEAVY_MODULES = ("bs4", "soupsieve", "lxml.etree", "cloudscraper", "requests", "urllib3")
+
+CHECKS = {
+    "import main": ("main", "import main"),
+    "main.py -h": ("main", "import main; main.print_usage(main.get_regions()['all'])"),
+    "list restaurants": ("main", "import main; main.list_restaurants()"),
+    "import flask_app": ("flask", "import flask_app"),
+    "/api/restaurant": ("flask", "import flask_app; flask_app.app.test_client().get('/api/restaurant')"),
+}
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps({{"ms": seconds * 1000, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(code: str) -> dict:
+    """
+    Run the code in a new interpreter, returning the time taken and the imported modules
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(code=code)],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+        env=dict(os.environ, PYTHONPATH=BACKEND_DIR),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run(runs: int, budgets: dict) -> bool:
+    """
+    Run all checks and print the results, returning whether all of them passed
+    """
+    passed = True
+    print(f"{'check':<20}{'ms':>8}{'budget':>8}  heavy modules")
+    for name, (kind, code) in CHECKS.items():
+        results = [measure(code) for _ in range(runs)]
+        fastest = min(result["ms"] for result in results)
+        heavy = sorted({module for result in results for module in result["modules"] if module in HEAVY_MODULES})
+        ok = fastest <= budgets[kind] and not heavy
+        passed = passed and ok
+        print(f"{name:<20}{fastest:>8.1f}{budgets[kind]:>8.0f}  {', '.join(heavy) or '-'}{'' if ok else '  FAILED'}")
+    return passed
+
+
+if __name__ == "__main__":
+    ARGS = argparse.ArgumentParser(description="Check the startup time of the backend")
+    ARGS.add_argument("-n", "--runs", type=int, default=5, help="runs per check (default 5)")
+    ARGS.add_argument("--main-ms", type=float, default=100, help="budget for main (default 100 ms)")
+    ARGS.add_argument("--flask-ms", type=float, default=300, help="budget for flask_app (default 300 ms)")
+    OPTIONS = ARGS.parse_args()
+
+    if not run(OPTIONS.runs, {"main": OPTIONS.main_ms, "flask": OPTIONS.flask_ms}):
+        sys.exit(1)
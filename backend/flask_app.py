@@ -1,9 +1,24 @@
+import gzip
+import hashlib
+import os
+from datetime import date
+
 import flask
 import flask_caching
 import flask_cors
 
 import main
+import metrics
+import registry
+import scheduler
 import slack
+import storage
+
+# brotli is optional, without it the responses are only offered with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = flask.Flask(__name__)
 cache = flask_caching.Cache(app, config={"CACHE_TYPE": "simple"})
@@ -11,6 +26,10 @@ cors = flask_cors.CORS(app, resources={r"/*": {"origins": "*"}})
 
 app.register_blueprint(slack.blueprint, url_prefix="/api/slack")
 
+# fetch all menus in the background at this time (HH:MM) every weekday
+if os.environ.get("MENU_WARM_TIME"):
+    scheduler.start(os.environ["MENU_WARM_TIME"])
+
 
 @app.route("/api")
 @cache.cached(timeout=10800)
@@ -19,19 +38,141 @@ def list_entities():
                     "url": flask.url_for("list_entities", _external=True)})
 
 
+# cached per version of restaurants.json
 @app.route("/api/restaurant")
-@cache.cached(timeout=10800)
+@cache.cached(timeout=10800, key_prefix=lambda: f"restaurants/{registry.get().version}")
 def list_restaurants():
     return flask.jsonify({"restaurants": main.list_restaurants(),
                     "url": flask.url_for("list_restaurants", _external=True)})
 
 
+# timing and failures of the parsers in this process
+@app.route("/api/metrics")
+def get_metrics():
+    return flask.Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# restaurants skipped because of repeated errors
+@app.route("/api/circuits")
+def get_circuits():
+    return flask.jsonify({"circuits": main.open_circuits(),
+                    "url": flask.url_for("get_circuits", _external=True)})
+
+
+# encoded responses of get_restaurant: (day, fetch time, url) and the encoding, by identifier
+_RESPONSES = {}
+
+
+def encode_restaurant(data: dict, url: str) -> dict:
+    """
+    Serialize the response for a restaurant once, in every content coding
+
+    Returns the body for each coding (identity, gzip and, if brotli is installed, br)
+    and the hash of the uncompressed body.
+    """
+    data = dict(data, menu=[{"dish": entry} for entry in data["menu"]])
+    body = (flask.json.dumps({"restaurant": data, "url": url}, separators=(",", ":")) + "\n").encode()
+    encoded = {"identity": body, "gzip": gzip.compress(body)}
+    if brotli:
+        encoded["br"] = brotli.compress(body)
+    return {"digest": hashlib.sha256(body).hexdigest(), "bodies": encoded}
+
+
+# the menus are cached per day by main.get_restaurant, and their encoded responses
+# per process until the menu is fetched again
 @app.route("/api/restaurant/<name>")
-@cache.cached(timeout=10800)
 def get_restaurant(name):
-    data = dict(main.get_restaurant(name))
-    if not data:
+    restaurant_data = registry.get().restaurants
+    if name not in restaurant_data:
+        flask.abort(status=404)
+    url = flask.url_for("get_restaurant", name=name, _external=True)
+    # read before the menu, so that a menu stored in between is not cached as the older one
+    today = storage.today()
+    fetched = storage.get_menu_fetched(name, today)
+    key = (today, fetched, url)
+    cached = _RESPONSES.get(name)
+    # the stored menu is only looked up (and decoded) again when it has changed, or is due
+    # to be refreshed; menus that are not stored (e.g. after a failed fetch) are encoded
+    # every time
+    changed = fetched is None or cached is None or cached[0] != key
+    if changed or main.is_stale(name, restaurant_data, fetched, today):
+        data = main.get_restaurant(name)
+        if not data:
+            flask.abort(status=404)
+        if changed:
+            cached = _RESPONSES[name] = (key, encode_restaurant(data, url))
+    encoded = cached[1]
+
+    # the smallest coding the client accepts, br before gzip at the same quality
+    accepted = flask.request.accept_encodings
+    codings = [coding for coding in ("br", "gzip") if coding in encoded["bodies"] and accepted.quality(coding)]
+    coding = max(codings, key=accepted.quality, default="identity")
+    response = flask.Response(encoded["bodies"][coding], mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if coding != "identity":
+        response.content_encoding = coding
+    # each coding is its own representation, so it gets its own strong etag
+    response.set_etag(encoded["digest"] if coding == "identity" else f"{encoded['digest']}-{coding}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+@app.route("/api/menus")
+def get_menus():
+    """
+    Menus of several restaurants, selected by ?ids=a,b,c or ?region=name (default all)
+    """
+    if flask.request.args.get("ids"):
+        names = flask.request.args["ids"].split(",")
+    else:
+        region = flask.request.args.get("region", "").lower()
+        current = registry.get()
+        names = current.by_region.get(region, ()) if region else current.restaurants
+    restaurants = []
+    for identifier, data in main.get_menus(names).items():
+        data = dict(data, identifier=identifier)
+        data["menu"] = [{"dish": entry} for entry in data["menu"]]
+        restaurants.append(data)
+    if not restaurants:
+        flask.abort(status=404)
+    response = flask.jsonify({"restaurants": restaurants,
+                              "url": flask.request.url})
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+@app.route("/api/search")
+def search():
+    """
+    Dishes in the stored menus with all words in ?q=, optionally only for ?region= and ?day=
+    (ISO date or today)
+    """
+    query = flask.request.args.get("q", "").strip()
+    if not query:
+        flask.abort(status=400)
+    day = flask.request.args.get("day")
+    if day == "today":
+        day = storage.today()
+    elif day:
+        try:
+            day = date.fromisoformat(day)
+        except ValueError:
+            flask.abort(status=400)
+    return flask.jsonify({"results": main.search_dishes(query, flask.request.args.get("region"), day),
+                    "url": flask.request.url})
+
+
+@app.route("/api/page/<region>")
+def get_page(region):
+    """
+    The HTML page for a region (see main.find_region), sent as each menu is ready
+
+    With ?order=completion the restaurants come in the order they are ready.
+    """
+    restaurants = main.find_region(region)
+    if restaurants is None:
         flask.abort(status=404)
-    data["menu"] = [{"dish": entry} for entry in data["menu"]]
-    return flask.jsonify({"restaurant": data,
-                    "url": flask.url_for("get_restaurant", name=name, _external=True)})
+    restaurant_data = registry.get().restaurants
+    ordered = flask.request.args.get("order") != "completion"
+    return flask.Response(main.stream_page(restaurants, restaurant_data, ordered=ordered), mimetype="text/html")
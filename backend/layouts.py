@@ -0,0 +1,119 @@
+"""
+Declarative parsing of common menu layouts.
+
+A layout is a dict naming a template and the CSS selectors to use with it, e.g. from
+the "layout" of a restaurant in restaurants.json:
+
+    {
+        "template": "day-heading",
+        "only": {"tag": "div", "class": "week-container"},
+        "days": "div.day",
+        "heading": "h2",
+        "dishes": "div.title",
+        "min_length": 2
+    }
+
+Templates:
+    day-blocks: The page has one block per weekday, in order from monday. Options:
+        days (selector for the blocks), dishes (selector within a block).
+    day-heading: The page has one block per day, with the weekday name in a heading.
+        Options: days (selector for the blocks), heading (selector within a block),
+        dishes (selector within a block), lang (language of the weekday names, sv or en).
+
+Common options:
+    only: The tag (and "class" or "id") holding the menu, the only part of the page parsed.
+    skip: Number of dishes to skip at the start of a block.
+    min_length: Skip dishes with shorter text.
+    single_line: Replace line breaks in the dishes with spaces.
+
+The selectors are compiled once per layout and process.
+"""
+import functools
+import json
+
+import soupsieve
+
+
+class Layout:
+    """
+    Base for the templates
+    """
+
+    def __init__(self, layout: dict):
+        self.only = layout.get("only")
+        self.lang = layout.get("lang", "sv")
+        self.min_length = layout.get("min_length", 0)
+        self.single_line = layout.get("single_line", False)
+        self.skip = layout.get("skip", 0)
+        self.dishes = soupsieve.compile(layout["dishes"])
+
+    def dish_texts(self, block) -> list:
+        """
+        The text of the dishes in a block
+        """
+        texts = []
+        for dish in self.dishes.select(block)[self.skip:]:
+            text = dish.get_text().strip()
+            if self.single_line:
+                text = text.replace("\n", " ")
+            if len(text) >= self.min_length:
+                texts.append(text)
+        return texts
+
+    def extract(self, soup, wdigit: int, day_name: str) -> list:
+        """
+        The dishes for a weekday (monday = 0), named day_name in the language of the layout
+        """
+        raise NotImplementedError
+
+
+class DayBlocks(Layout):
+    """
+    One block per weekday, in order
+    """
+
+    def __init__(self, layout: dict):
+        super().__init__(layout)
+        self.days = soupsieve.compile(layout["days"])
+
+    def extract(self, soup, wdigit: int, day_name: str) -> list:
+        return self.dish_texts(self.days.select(soup)[wdigit])
+
+
+class DayHeading(Layout):
+    """
+    One block per day, found by the weekday name in its heading
+    """
+
+    def __init__(self, layout: dict):
+        super().__init__(layout)
+        self.days = soupsieve.compile(layout["days"])
+        self.heading = soupsieve.compile(layout["heading"])
+
+    def extract(self, soup, wdigit: int, day_name: str) -> list:
+        for block in self.days.select(soup):
+            heading = self.heading.select_one(block)
+            if heading and day_name.lower() in heading.get_text().lower():
+                return self.dish_texts(block)
+        return []
+
+
+TEMPLATES = {
+    "day-blocks": DayBlocks,
+    "day-heading": DayHeading,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(layout_json: str) -> Layout:
+    layout = json.loads(layout_json)
+    if layout.get("template") not in TEMPLATES:
+        raise ValueError(f"Unknown layout template: {layout.get('template')}")
+    return TEMPLATES[layout["template"]](layout)
+
+
+def compile_layout(layout: dict) -> Layout:
+    """
+    Get the compiled extractor for a layout, reusing it if it has been compiled before
+    """
+    return _compile(json.dumps(layout, sort_keys=True))
@@ -31,34 +31,48 @@
 Main script for choosing what restaurant parsers to use.
 """
 
+import hashlib
+import itertools
 import json
 import os
 import re
 import sys
-from datetime import date, datetime, tzinfo
-import pytz
-import locale
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from datetime import date, datetime, timedelta, tzinfo
+import metrics
 import parser as ps
+import registry
+import storage
+from singleflight import SingleFlight
 from time import timezone
 
-__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-REST_FILENAME = os.path.join(__location__, "restaurants.json")
+# number of restaurants fetched in parallel, and seconds to wait for each of them
+WORKERS = int(os.environ.get("MENU_WORKERS", 8))
+TIMEOUT = float(os.environ.get("MENU_TIMEOUT", 30))
 
+# concurrent requests for the same menu share one fetch
+FLIGHTS = SingleFlight()
 
-def read_restaurants(intext: str) -> dict:
-    """
-    Parse the list of restaurants from the restaurants file.
+# seconds before a stored menu is refreshed in the background (0 to never refresh it)
+MAX_AGE = float(os.environ.get("MENU_MAX_AGE", 3 * 3600))
+# off in the CLI runs, which use the menus once and exit
+REVALIDATE = True
+# seconds to wait before fetching a restaurant again after a failed fetch, doubled for
+# every failure in a row
+FAILURE_BACKOFF = float(os.environ.get("MENU_FAILURE_BACKOFF", 60))
+FAILURE_MAX_BACKOFF = float(os.environ.get("MENU_FAILURE_MAX_BACKOFF", 3600))
 
-    Args:
-        intext(str): The text loaded from the restaurants file.
-    """
-    indata = json.loads(intext)
-    data = dict()
-    for entry in indata["restaurants"]:
-        data[entry["identifier"]] = entry
-    return data
+# errors in a row (in fetching or parsing) before a restaurant is skipped, and for how
+# many seconds it is skipped
+CIRCUIT_THRESHOLD = int(os.environ.get("MENU_CIRCUIT_THRESHOLD", 5))
+CIRCUIT_COOLDOWN = float(os.environ.get("MENU_CIRCUIT_COOLDOWN", 6 * 3600))
 
-REST_DATA = read_restaurants(open(REST_FILENAME).read())
+_REVALIDATOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="menu-revalidate")
+_REVALIDATING = set()
+_REVALIDATING_LOCK = threading.Lock()
 
 # works as ordered dict as well, but must be _ordered_
 MAPPER = {
@@ -77,27 +91,379 @@ MAPPER = {
     "tallrik": ps.parse_tallrik,
     "nordicforum": ps.parse_nordicforum,
     "tastorykista": ps.parse_tastorykista,
-    "glaze": ps.parse_glaze
+    "glaze": ps.parse_layout
 
 }
 
 
-KI = ("jorpes", "glada", "haga", "hjulet", "jons", "livet", "nanna", "svarta")
+# the old names of the regions (in the CLI and the page names), keyed by region in
+# restaurants.json (lower case)
+REGION_PAGES = {"solna": "ki", "uppsala": "uu", "kista": "ka"}
+
+
+def find_parser(name: str, restaurant_data: dict):
+    """
+    Find the parser to use for a restaurant
+
+    Restaurants with a "layout" in restaurants.json use it.
+    Returns None if there is no parser for the restaurant.
+    """
+    if name in restaurant_data and "layout" in restaurant_data[name]:
+        return ps.parse_layout
+    if name in restaurant_data and ".kvartersmenyn.se" in restaurant_data[name]["menuUrl"]:
+        return ps.parse_kvartersmenyn
+    return MAPPER.get(name)
+
+
+def get_regions() -> dict:
+    """
+    The restaurants with a parser in each region of restaurants.json, and in all of them
+
+    Keyed by page name: the old name of the region if it has one (see REGION_PAGES),
+    otherwise the region (lower case), and "all" for all restaurants.
+    """
+    current = registry.get()
+    regions = {}
+    for region, names in current.by_region.items():
+        regions[REGION_PAGES.get(region, region)] = tuple(
+            name for name in names if find_parser(name, current.restaurants)
+        )
+    regions["all"] = tuple(name for names in regions.values() for name in names)
+    return regions
+
+
+def find_region(name: str) -> tuple:
+    """
+    The restaurants of a region, by page name (e.g. ka), region (e.g. kista) or all
+
+    Returns None if there is no such region.
+    """
+    name = name.lower()
+    return get_regions().get(REGION_PAGES.get(name, name))
+
+
+def fetch_restaurant(
+    name: str, restaurant_data: dict, refresh: bool = False, dates: ps.DateContext = None
+) -> dict:
+    """
+    Get the menu of a restaurant, from the storage if it has already been fetched
+
+    The menu is for the day of dates (default today). With refresh, the menu is always
+    fetched again. The stored menu is kept (and returned) if the new fetch fails.
+
+    Returns an empty dict if there is no parser for the restaurant.
+    """
+    parser = find_parser(name, restaurant_data)
+    if not parser or name not in restaurant_data:
+        return {}
+    dates = dates or ps.DateContext.today()
+    if refresh and not circuit_open(name):
+        data = None
+    else:
+        data = cached_menu(name, restaurant_data, dates)
+    if data is None:
+        data = FLIGHTS.do(
+            (name, dates.day, refresh), _fetch_and_store, parser, name, restaurant_data, refresh, dates
+        )
+        data = dict(data)
+    return data
+
+
+def cached_menu(name: str, restaurant_data: dict, dates: ps.DateContext = None) -> dict:
+    """
+    Get the stored menu of a restaurant
+
+    A stored menu that is stale (see is_stale) is returned as it is, while it is fetched
+    again in the background (if REVALIDATE). Without REVALIDATE (in the CLI runs), only a
+    menu stored ahead of time is fetched again, at once. After a failed fetch, or while
+    the circuit of the restaurant is open, an empty menu is returned until the restaurant
+    is due to be tried again.
+
+    The menu is for the day of dates (default today).
+    Returns None if the menu has to be fetched.
+    """
+    dates = dates or ps.DateContext.today()
+    data = storage.get_menu(name, dates.day)
+    waiting = backing_off(name)
+    if data is not None:
+        fetched = storage.get_menu_fetched(name, dates.day)
+        if not waiting and is_stale(name, restaurant_data, fetched, dates.day):
+            if REVALIDATE:
+                _revalidate_in_background(name, restaurant_data, dates)
+            elif datetime.fromtimestamp(fetched, storage.TIMEZONE).date() < dates.day:
+                _revalidate(name, restaurant_data, dates)
+                data = storage.get_menu(name, dates.day) or data
+        return data
+    if waiting:
+        return dict(ps.restaurant_info(restaurant_data[name]), menu=[])
+    return None
+
+
+def backing_off(name: str) -> bool:
+    """
+    Check if a restaurant should not be fetched now, after a failed fetch or while its
+    circuit is open
+    """
+    failure = storage.get_failure(name)
+    return failure is not None and failure["retry_at"] > time.time() or circuit_open(name)
+
+
+def is_stale(name: str, restaurant_data: dict, fetched: float, day: date) -> bool:
+    """
+    Check if the stored menu of a restaurant for the day, fetched at the given time
+    (seconds since the epoch), is due to be fetched again
+
+    A menu fetched on its day is stale after MAX_AGE (if set). A menu stored ahead of time
+    from a weekly page is fetched again once on its day, as most weekly pages cannot be
+    checked to show the right week (e.g. when fetched before the site switched weeks),
+    unless its parser checks the week.
+    """
+    if not fetched:
+        return False
+    if datetime.fromtimestamp(fetched, storage.TIMEZONE).date() < day:
+        return not getattr(find_parser(name, restaurant_data), "checks_week", False)
+    return bool(MAX_AGE) and time.time() - fetched > MAX_AGE
+
+
+def _revalidate_in_background(name: str, restaurant_data: dict, dates: ps.DateContext):
+    """
+    Fetch the menu of a restaurant again in a background thread, unless already in progress
+    """
+    with _REVALIDATING_LOCK:
+        if (name, dates.day) in _REVALIDATING:
+            return
+        _REVALIDATING.add((name, dates.day))
+    future = _REVALIDATOR.submit(_revalidate, name, restaurant_data, dates)
+    future.add_done_callback(lambda _: _REVALIDATING.discard((name, dates.day)))
+
+
+def _revalidate(name: str, restaurant_data: dict, dates: ps.DateContext):
+    """
+    Fetch the menu of a restaurant again, unless another process just did
+    """
+    try:
+        with storage.lock(name):
+            fetched = storage.get_menu_fetched(name, dates.day)
+            if fetched and not is_stale(name, restaurant_data, fetched, dates.day):
+                return
+            data = find_parser(name, restaurant_data)(restaurant_data[name], dates)
+            store_menus(name, data, dates.day)
+            record_result(name, data, dates.day)
+    except Exception as err:  # pylint: disable=broad-except
+        sys.stderr.write(f"E in revalidating {name}: {err}\n")
+
+
+def _fetch_and_store(parser, name: str, restaurant_data: dict, refresh: bool, dates: ps.DateContext) -> dict:
+    """
+    Run the parser of a restaurant and store the result
+
+    Only one process at a time fetches a restaurant, and the others use its result, also
+    when it failed: they get an empty menu while the restaurant is backing off (a refresh
+    only waits for an open circuit).
+    """
+    with storage.lock(name):
+        data = None if refresh else storage.get_menu(name, dates.day)
+        if data is None and (circuit_open(name) or not refresh and backing_off(name)):
+            data = dict(ps.restaurant_info(restaurant_data[name]), menu=[])
+        if data is None:
+            data = parser(restaurant_data[name], dates)
+            store_menus(name, data, dates.day)
+            record_result(name, data, dates.day)
+            if refresh and not data["menu"]:
+                data = storage.get_menu(name, dates.day) or data
+    return data
+
+
+def record_result(name: str, data: dict, day: date = None):
+    """
+    Keep track of failed fetches of a restaurant, to back off from it exponentially, and
+    of the errors in the latest parser call (in this thread), for its circuit
+
+    An empty menu counts as a failure. Only fetches for today (the default day) are
+    recorded, as e.g. the empty menus of a weekend day fetched ahead of time say nothing
+    about the menus served today.
+    """
+    if day is not None and day != storage.today():
+        return
+    call = metrics.last_call()
+    record_circuit(name, call.error if call and call.name == name else None)
+    if data["menu"]:
+        storage.clear_failure(name)
+        return
+    failure = storage.get_failure(name)
+    count = failure["count"] + 1 if failure else 1
+    backoff = min(FAILURE_BACKOFF * 2 ** (count - 1), FAILURE_MAX_BACKOFF)
+    storage.put_failure(name, count, time.time() + backoff)
+
+
+def record_circuit(name: str, error: str):
+    """
+    Count the errors in a row for a restaurant, and open its circuit after CIRCUIT_THRESHOLD
+
+    While the circuit is open the restaurant is not fetched. After CIRCUIT_COOLDOWN seconds
+    it is tried once more, and the circuit is opened again at once if that fails as well.
+    """
+    if not error:
+        storage.clear_circuit(name)
+        return
+    circuit = storage.get_circuit(name)
+    errors = circuit["errors"] + 1 if circuit else 1
+    open_until = None
+    if errors >= CIRCUIT_THRESHOLD:
+        open_until = time.time() + CIRCUIT_COOLDOWN
+        sys.stderr.write(f"E in {name}: {errors} errors in a row, skipping it for {CIRCUIT_COOLDOWN} seconds\n")
+    storage.put_circuit(name, errors, error, open_until)
+
+
+def circuit_open(name: str) -> bool:
+    """
+    Check if the circuit of a restaurant is open, i.e. it should not be fetched
+    """
+    circuit = storage.get_circuit(name)
+    return circuit is not None and circuit["open_until"] is not None and circuit["open_until"] > time.time()
+
+
+def open_circuits() -> dict:
+    """
+    The restaurants that are not fetched because of repeated errors, keyed by identifier
+
+    Each one has the number of errors in a row, the latest error and when it will be
+    fetched again (ISO time).
+    """
+    circuits = {}
+    for name, circuit in storage.get_circuits().items():
+        if circuit["open_until"] is not None and circuit["open_until"] > time.time():
+            circuits[name] = {
+                "errors": circuit["errors"],
+                "error": circuit["error"],
+                "retry_at": datetime.fromtimestamp(circuit["open_until"], storage.TIMEZONE).isoformat(),
+            }
+    return circuits
+
+
+def store_menus(name: str, data: dict, current: date = None):
+    """
+    Store the menu of a restaurant for the current day (default today), and for the rest
+    of the week if available
+
+    The menus for the week are removed from data.
+    """
+    current = current or storage.today()
+    menus = {}
+    for day, menu in data.pop("week", {}).items():
+        day = date.fromisoformat(day)
+        # an empty menu is most likely a failed fetch, so try again next time
+        if day > current and menu:
+            menus[day] = dict(data, menu=menu)
+    if data["menu"]:
+        menus[current] = data
+    if menus:
+        storage.put_menus(name, menus)
+
+
+def _run_fetch(
+    name: str, restaurant_data: dict, refresh: bool, dates: ps.DateContext, started: dict, index: int
+) -> dict:
+    """
+    Fetch the menu of a restaurant, recording when it was started
+    """
+    started[index] = time.monotonic()
+    return fetch_restaurant(name, restaurant_data, refresh, dates)
+
+
+def fetch_menus(
+    restaurants,
+    restaurant_data,
+    workers: int = WORKERS,
+    timeout: float = TIMEOUT,
+    refresh: bool = False,
+    dates: ps.DateContext = None,
+) -> list:
+    """
+    Run the parsers for the restaurants concurrently.
+
+    The menus are returned in the same order as restaurants. A parser that has not finished
+    timeout seconds after it was started is given up on and gets an empty menu, without
+    delaying the other restaurants. The menus are for the day of dates (default today).
+    """
+    menus = iter_menus(restaurants, restaurant_data, workers, timeout, refresh, dates=dates)
+    return [data for _, data in menus]
+
 
-UU = ("bikupan", "dufva", "hubben", "rudbeck", "tallrik")
+def _timed_out(restaurant: str, restaurant_data: dict, timeout: float) -> dict:
+    """
+    The data for a restaurant that was given up on
+    """
+    sys.stderr.write(f"E in {restaurant}: no response within {timeout} seconds\n")
+    return dict(ps.restaurant_info(restaurant_data[restaurant]), menu=[])
+
+
+def iter_menus(
+    restaurants,
+    restaurant_data,
+    workers: int = WORKERS,
+    timeout: float = TIMEOUT,
+    refresh: bool = False,
+    ordered: bool = True,
+    dates: ps.DateContext = None,
+):
+    """
+    Run the parsers for the restaurants concurrently, yielding (index, menu) as they are done.
 
-KA = ("uppereast", "nordicforum", "tastorykista", "eaterygate", "eaterynod", "wildkitchen", "glaze")
+    The menus are yielded in the order of restaurants if ordered, otherwise as soon as
+    each of them is finished. Timeouts and dates are handled as in fetch_menus; all the
+    parsers get the same date context, also if the run passes midnight.
+    """
+    dates = dates or ps.DateContext.today()
+    started = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [
+        executor.submit(_run_fetch, restaurant, restaurant_data, refresh, dates, started, i)
+        for i, restaurant in enumerate(restaurants)
+    ]
 
+    try:
+        if ordered:
+            for i, restaurant in enumerate(restaurants):
+                while True:
+                    start = started.get(i)
+                    remaining = start + timeout - time.monotonic() if start is not None else timeout
+                    try:
+                        yield i, futures[i].result(timeout=max(remaining, 0))
+                        break
+                    except TimeoutError:
+                        if started.get(i) is not None and started[i] + timeout <= time.monotonic():
+                            yield i, _timed_out(restaurant, restaurant_data, timeout)
+                            break
+        else:
+            pending = {future: i for i, future in enumerate(futures)}
+            while pending:
+                deadlines = [started[i] + timeout for i in pending.values() if i in started]
+                remaining = min(deadlines) - time.monotonic() if deadlines else timeout
+                done, _ = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+                for future, i in list(pending.items()):
+                    if i in started and started[i] + timeout <= time.monotonic():
+                        del pending[future]
+                        yield i, _timed_out(restaurants[i], restaurant_data, timeout)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def activate_parsers(restaurants, restaurant_data, dates: ps.DateContext = None):
+    """
+    Run the wanted parsers, for the day of dates (default today)
+    """
+    return render_menus(fetch_menus(restaurants, restaurant_data, dates=dates))
 
-def activate_parsers(restaurants, restaurant_data):
+
+def render_menus(menus) -> str:
     """
-    Run the wanted parsers
+    Create the HTML for the menus of the restaurants
     """
     output = []
-    for restaurant in restaurants:
-        if ".kvartersmenyn.se" in restaurant_data[restaurant]["menuUrl"]:
-            MAPPER[restaurant] = ps.parse_kvartersmenyn
-        data = MAPPER[restaurant](restaurant_data[restaurant])
+    for data in menus:
         output.append(f"""<div class="title">\n\t<a class="gmaps" href="{data['map_url']}"></a>""")
         output.append(
             f"""\t<a href="{data['url']}">{data['title']}</a></div>"""
@@ -115,17 +481,65 @@ def get_restaurant(name: str) -> dict:
     """
     Request the menu of a restaurant
     """
-    if name in MAPPER:
-        return MAPPER[name](REST_DATA[name])
-    else:
-        return {}
+    return fetch_restaurant(name, registry.get().restaurants)
+
+
+def get_menus(names) -> dict:
+    """
+    Request the menus of several restaurants concurrently
+
+    Unknown restaurants are skipped. The menus are keyed by identifier, in the order of names.
+    """
+    restaurants = registry.get().restaurants
+    names = [name for name in dict.fromkeys(names) if name in restaurants and find_parser(name, restaurants)]
+    return dict(zip(names, fetch_menus(names, restaurants)))
+
+
+def warm(day: date = None) -> dict:
+    """
+    Fetch the menus of all restaurants again, replacing the stored ones
+
+    The menus are for the day (default today), so e.g. the menus of tomorrow can be
+    fetched ahead of time. The old menus are served until the new ones are stored. The restaurants are taken
+    from each site in turn, so the workers are not all waiting for the same site.
+    """
+    current = registry.get()
+    names = [
+        name
+        for group in itertools.zip_longest(*current.by_site.values())
+        for name in group
+        if name and find_parser(name, current.restaurants)
+    ]
+    dates = ps.DateContext.for_day(day) if day else ps.DateContext.today()
+    return dict(zip(names, fetch_menus(names, current.restaurants, refresh=True, dates=dates)))
 
 
 def list_restaurants():
     """
     List all supported restaurants.
+
+    The entries are shared, and must not be modified.
     """
-    return list(REST_DATA.values())
+    return registry.get().entries
+
+
+def search_dishes(query: str, region: str = None, day: date = None) -> list:
+    """
+    Search the archived menus, without fetching anything
+
+    Args:
+        query (str): The words that must all be in the dish (or start words in it).
+        region (str): Only search the restaurants in the region (e.g. Kista).
+        day (date): Only search the menus of the day.
+
+    Returns the dishes with the restaurant identifier, title and day, newest first.
+    """
+    current = registry.get()
+    identifiers = current.by_region.get(region.lower(), ()) if region else None
+    results = storage.search_archive(query.split(), identifiers, day)
+    for result in results:
+        result["title"] = current.restaurants.get(result["identifier"], {}).get("name", result["identifier"])
+    return results
 
 
 def page_end():
@@ -137,7 +551,7 @@ def page_end():
     lines.append("</div>")
     lines.append(
         '<div class="updated">'+
-        datetime.now(pytz.timezone("Europe/Stockholm")).strftime("%Y-%m-%d %H:%M:%S") +
+        datetime.now(storage.TIMEZONE).strftime("%Y-%m-%d %H:%M:%S") +
         '</div>'
     )
     lines.append('<div class="footer">')
@@ -178,11 +592,13 @@ def parse_restaurant_names(rest_names):
     """
     Decide what restaurants to generate menus for
     """
+    restaurant_data = registry.get().restaurants
     restaurants = list()
     for param in rest_names:
-        if param not in KI and param not in UU and param not in KA:
+        param = param.lower()
+        if param not in restaurant_data or not find_parser(param, restaurant_data):
             raise ValueError("{} not a valid restaurant".format(param))
-        restaurants.append(param.lower())
+        restaurants.append(param)
     return restaurants
 
 
@@ -193,27 +609,124 @@ def print_usage(supported):
     sys.stderr.write("Usage: {} restaurant1 [...] \n".format(sys.argv[0]))
     sys.stderr.write("Supported restaurants: {}\n".format(", ".join(sorted(supported))))
     sys.stderr.write("Write all to generate all supported restaurants\n")
+    sys.stderr.write("Write a region ({}) to generate its restaurants\n".format(
+        ", ".join(region for region in get_regions() if region != "all")))
+    sys.stderr.write("Write warm to fetch and store the menus of all restaurants\n")
+    sys.stderr.write("    (add tomorrow or YYYY-MM-DD to fetch the menus of another day)\n")
+    sys.stderr.write("Write build <directory> to write the pages of all regions to the directory\n")
+    sys.stderr.write("    (only the pages with changed menus, add -f to write all)\n")
+    sys.stderr.write("Write search <words> to find the dishes with the words in the stored menus\n")
+    sys.stderr.write("Add -t to print the time spent on each restaurant\n")
+    sys.stderr.write("Add -c to print the restaurants in the order they are ready\n")
+    sys.stderr.write("Add -r to fetch the menus again instead of using the stored ones\n")
+
+
+def page_header(dates: ps.DateContext) -> str:
+    """
+    The start of the page for the day of dates
+    """
+    return "\n".join(page_start(dates.weekday_sv, str(dates.day.day), dates.month))
+
+
+def stream_page(restaurants, restaurant_data, ordered: bool = True, refresh: bool = False):
+    """
+    Generate a full page with the menus of the restaurants, piece by piece
+
+    The start of the page is yielded at once, and the menu of each restaurant as soon as
+    it is ready: in the order of restaurants if ordered, otherwise as each one is finished.
+    With refresh, the menus are fetched again instead of using the stored ones.
+    """
+    dates = ps.DateContext.today()
+    yield page_header(dates) + "\n"
+    for _, data in iter_menus(restaurants, restaurant_data, refresh=refresh, ordered=ordered, dates=dates):
+        yield render_menus([data]) + "\n"
+    yield "\n".join(page_end()) + "\n"
+
+
+def assemble_page(content: str, dates: ps.DateContext = None) -> str:
+    """
+    Create a full page around already rendered menus, for the day of dates (default today)
+    """
+    lines = [
+        page_header(dates or ps.DateContext.today()),
+        content,
+        "\n".join(page_end()),
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_fragment(name: str, data: dict) -> tuple:
+    """
+    Create the HTML for the menu of a restaurant, reusing the stored HTML if the menu is unchanged
+
+    Returns the hash of the menu and the HTML.
+    """
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    stored = storage.get_fragment(name)
+    if stored and stored[0] == digest:
+        return stored
+    html = render_menus([data])
+    storage.put_fragment(name, digest, html)
+    return digest, html
+
+
+def write_page(path: str, text: str):
+    """
+    Write a page, replacing the file atomically
+    """
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    with os.fdopen(handle, "w") as outfile:
+        outfile.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def build_site(outdir: str, regions: dict = None, force: bool = False) -> list:
+    """
+    Write the page of each region (default all, see get_regions) to outdir as <region>.html
+
+    Every restaurant is fetched once, concurrently. A page is only written if its date or
+    any of its menus changed since it was last built (as recorded in the storage), unless
+    force is set. Returns the paths of the written pages.
+    """
+    regions = regions or get_regions()
+    restaurant_data = registry.get().restaurants
+    dates = ps.DateContext.today()
+    names = list(dict.fromkeys(name for restaurants in regions.values() for name in restaurants))
+    for name in names:
+        if name not in restaurant_data:
+            sys.stderr.write(f"E: no data for {name}, skipping it\n")
+    names = [name for name in names if name in restaurant_data]
+    menus = fetch_menus(names, restaurant_data, dates=dates)
+    fragments = {name: render_fragment(name, data) for name, data in zip(names, menus)}
+
+    os.makedirs(outdir, exist_ok=True)
+    header = page_header(dates)
+    written = []
+    for region, restaurants in regions.items():
+        parts = [fragments[name] for name in restaurants if name in fragments]
+        digest = hashlib.sha256("\n".join([header] + [part[0] for part in parts]).encode()).hexdigest()
+        path = os.path.join(outdir, f"{region}.html")
+        if not force and storage.get_build(os.path.abspath(path)) == digest:
+            continue
+        write_page(path, assemble_page("\n".join(part[1] for part in parts), dates))
+        storage.put_build(os.path.abspath(path), digest)
+        written.append(path)
+    return written
 
 
 def gen_ki_menu():
     """
     Generate a menu for restaurants at KI
     """
-    output = ""
-    output += "\n".join(page_start(ps.get_weekday(), str(ps.get_day()), ps.get_month()))
-    output += activate_parsers(KI, REST_DATA)
-    output += "\n".join(page_end())
-    return output
+    return "".join(stream_page(find_region("ki") or (), registry.get().restaurants))
 
 
 def gen_uu_menu():
     """
     Generate a menu for restaurants at UU
     """
-    output = ""
-    output += "\n".join(page_start(ps.get_weekday(), str(ps.get_day()), ps.get_month()))
-    output += activate_parsers(UU, REST_DATA)
-    output += "\n".join(page_end())
+    output = "".join(stream_page(find_region("uu") or (), registry.get().restaurants))
 
     sys.stderr.write(output + "\n")
     return output
@@ -222,10 +735,7 @@ def gen_kista_menu():
     """
     Generate a menu for restaurants at KISTA
     """
-    output = ""
-    output += "\n".join(page_start(ps.get_weekday(), str(ps.get_day()), ps.get_month()))
-    output += activate_parsers(KA, REST_DATA)
-    output += "\n".join(page_end())
+    output = "".join(stream_page(find_region("ka") or (), registry.get().restaurants))
 
     sys.stderr.write(output + "\n")
     return output
@@ -233,29 +743,71 @@ def gen_kista_menu():
 
 if __name__ == "__main__":
     if len(sys.argv) < 2 or "-h" in sys.argv:
-        print_usage(KI + UU + KA)
+        print_usage(get_regions()["all"])
         sys.exit()
 
-    REST_NAMES_IN = tuple()
-    if "all" in sys.argv[1:]:
-        REST_NAMES_IN += KI + UU + KA
-    elif "ki" in sys.argv[1:]:
-        REST_NAMES_IN += KI
-    elif "uu" in sys.argv[1:]:
-        REST_NAMES_IN += UU
-    elif "ka" in sys.argv[1:]:
-        REST_NAMES_IN += KA
-    else:
-        REST_NAMES_IN = [param for param in sys.argv[1:] if param != "-r"]
+    REVALIDATE = False
+
+    if sys.argv[1] == "warm":
+        WARM_DAY = None
+        if len(sys.argv) > 2 and sys.argv[2] != "-t":
+            try:
+                WARM_DAY = (
+                    storage.today() + timedelta(days=1)
+                    if sys.argv[2] == "tomorrow"
+                    else date.fromisoformat(sys.argv[2])
+                )
+            except ValueError:
+                print_usage(get_regions()["all"])
+                sys.exit(1)
+        for name, data in warm(WARM_DAY).items():
+            sys.stderr.write(f"{name}: {len(data['menu'])} dishes\n")
+        if "-t" in sys.argv:
+            sys.stderr.write(metrics.summary())
+        sys.exit()
+
+    if sys.argv[1] == "build":
+        if len(sys.argv) < 3:
+            print_usage(get_regions()["all"])
+            sys.exit(1)
+        WRITTEN = build_site(sys.argv[2], force="-f" in sys.argv)
+        for path in WRITTEN:
+            print(path)
+        if not WRITTEN:
+            sys.stderr.write("No menus changed\n")
+        # let a GitHub workflow skip the deployment
+        if os.environ.get("GITHUB_OUTPUT"):
+            with open(os.environ["GITHUB_OUTPUT"], "a") as outfile:
+                outfile.write(f"changed={'true' if WRITTEN else 'false'}\n")
+        if "-t" in sys.argv:
+            sys.stderr.write(metrics.summary())
+        sys.exit()
+
+    if sys.argv[1] == "search":
+        for result in search_dishes(" ".join(sys.argv[2:])):
+            print(f"{result['day']}  {result['title']}: {result['dish']}")
+        sys.exit()
+
+    REST_NAMES_IN = [param for param in sys.argv[1:] if param not in ("-r", "-t", "-c")]
+    # a region (or all) selects its restaurants
+    for PARAM in REST_NAMES_IN:
+        if find_region(PARAM) is not None:
+            REST_NAMES_IN = find_region(PARAM)
+            break
 
     try:
         REST_NAMES = parse_restaurant_names(REST_NAMES_IN)
     except ValueError as err:
         sys.stderr.write("E: {}\n".format(err))
-        print_usage((x for x in MAPPER))
+        print_usage(get_regions()["all"])
         sys.exit(1)
 
-    # print the menus
-    print("\n".join(page_start(ps.get_weekday(), str(ps.get_day()), ps.get_month())))
-    print(activate_parsers(REST_NAMES, REST_DATA))
-    print("\n".join(page_end()))
+    # print the menus, each restaurant as soon as it is ready
+    for chunk in stream_page(
+        REST_NAMES, registry.get().restaurants, ordered="-c" not in sys.argv, refresh="-r" in sys.argv
+    ):
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+
+    if "-t" in sys.argv:
+        sys.stderr.write(metrics.summary())
@@ -0,0 +1,172 @@
+"""
+Timing and failure statistics for the restaurant parsers.
+
+Every parser call is recorded with the time spent downloading and parsing, the size and
+HTTP status of the response, the number of dishes and the class of any exception. The
+totals are kept per process, and are labelled with its pid in the Prometheus format, so
+that the counters of each (gunicorn) worker stay monotonic, whichever worker is scraped.
+"""
+import contextlib
+import os
+import threading
+import time
+
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+_STATS = {}
+
+
+class Call:
+    """
+    Measurements for one call of a parser
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.fetch_seconds = 0.0
+        self.total_seconds = 0.0
+        self.size = 0
+        self.status = None
+        self.dishes = 0
+        self.error = None
+
+
+@contextlib.contextmanager
+def record(name: str):
+    """
+    Record a parser call for the restaurant, yielding the Call to fill in
+    """
+    call = Call(name)
+    previous = getattr(_LOCAL, "call", None)
+    _LOCAL.call = call
+    try:
+        yield call
+    finally:
+        _LOCAL.call = previous
+        _LOCAL.last = call
+        call.total_seconds = time.perf_counter() - call.start
+        _add(call)
+
+
+def last_call() -> Call:
+    """
+    The latest finished call in the current thread, or None
+    """
+    return getattr(_LOCAL, "last", None)
+
+
+def add_fetch(seconds: float, size: int, status: int, before: bool = False):
+    """
+    Add a page download to the current call, if any
+
+    With before, the download was made before the call started, and is added to its duration.
+    """
+    call = getattr(_LOCAL, "call", None)
+    if call:
+        if before:
+            call.start -= seconds
+        call.fetch_seconds += seconds
+        call.size += size
+        call.status = status
+
+
+def set_error(err: Exception):
+    """
+    Mark the current call, if any, as failed
+    """
+    call = getattr(_LOCAL, "call", None)
+    if call:
+        call.error = err.__class__.__name__
+
+
+def _add(call: Call):
+    """
+    Add a finished call to the totals
+    """
+    with _LOCK:
+        stats = _STATS.setdefault(
+            call.name,
+            {
+                "calls": 0,
+                "fetch_seconds": 0.0,
+                "parse_seconds": 0.0,
+                "bytes": 0,
+                "errors": {},
+                "last_status": None,
+                "last_dishes": 0,
+                "last_error": None,
+                "last_seconds": 0.0,
+            },
+        )
+        stats["calls"] += 1
+        stats["fetch_seconds"] += call.fetch_seconds
+        stats["parse_seconds"] += call.total_seconds - call.fetch_seconds
+        stats["bytes"] += call.size
+        if call.error:
+            stats["errors"][call.error] = stats["errors"].get(call.error, 0) + 1
+        stats["last_status"] = call.status
+        stats["last_dishes"] = call.dishes
+        stats["last_error"] = call.error
+        stats["last_seconds"] = call.total_seconds
+
+
+def get_stats() -> dict:
+    """
+    Copy of the totals per restaurant
+    """
+    with _LOCK:
+        return {name: dict(stats, errors=dict(stats["errors"])) for name, stats in _STATS.items()}
+
+
+def prometheus() -> str:
+    """
+    The totals in the Prometheus text format, labelled with the pid of the process
+
+    Sum over the worker label (e.g. sum without (worker) (rate(...))) for the totals of
+    all processes.
+    """
+    metrics = (
+        ("menu_parser_calls_total", "counter", "Parser calls", "calls"),
+        ("menu_fetch_seconds_total", "counter", "Time spent downloading pages", "fetch_seconds"),
+        ("menu_parse_seconds_total", "counter", "Time spent parsing pages", "parse_seconds"),
+        ("menu_response_bytes_total", "counter", "Size of downloaded pages", "bytes"),
+        ("menu_last_http_status", "gauge", "HTTP status of the latest download", "last_status"),
+        ("menu_last_dishes", "gauge", "Dishes found in the latest call", "last_dishes"),
+        ("menu_last_seconds", "gauge", "Duration of the latest call", "last_seconds"),
+    )
+    stats = get_stats()
+    worker = os.getpid()
+    lines = []
+    for metric, kind, description, key in metrics:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, entry in stats.items():
+            if entry[key] is not None:
+                lines.append(f'{metric}{{restaurant="{name}",worker="{worker}"}} {entry[key]}')
+    lines.append("# HELP menu_parser_errors_total Failed parser calls")
+    lines.append("# TYPE menu_parser_errors_total counter")
+    for name, entry in stats.items():
+        for error, count in entry["errors"].items():
+            lines.append(
+                f'menu_parser_errors_total{{restaurant="{name}",error="{error}",worker="{worker}"}} {count}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """
+    The totals as a table, slowest restaurant first
+    """
+    lines = [
+        f"{'restaurant':<16}{'calls':>6}{'fetch s':>9}{'parse s':>9}{'KiB':>8}{'status':>7}{'dishes':>7}  error"
+    ]
+    stats = get_stats()
+    for name in sorted(stats, key=lambda name: -(stats[name]["fetch_seconds"] + stats[name]["parse_seconds"])):
+        entry = stats[name]
+        lines.append(
+            f"{name:<16}{entry['calls']:>6}{entry['fetch_seconds']:>9.2f}{entry['parse_seconds']:>9.2f}"
+            f"{entry['bytes'] / 1024:>8.0f}{entry['last_status'] or '-':>7}{entry['last_dishes']:>7}"
+            f"  {entry['last_error'] or ''}"
+        )
+    return "\n".join(lines) + "\n"
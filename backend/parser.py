@@ -31,203 +31,346 @@
 Parsers of the menu pages for the restaurants at Karolinska Institutet
 """
 
+import contextlib
+import dataclasses
 import datetime
 from datetime import date
+import importlib.util
 import re
 import sys
 import html
+import os
+import threading
+import time
 
-import requests
-import cloudscraper
-from bs4 import BeautifulSoup
 from collections import defaultdict
 
+import metrics
+import session
+import storage
+
+# bs4 (and layouts, using soupsieve) take long to import, so they are only imported
+# when a page is parsed, keeping the startup fast for everything else
+
+# the tree builder for HTML pages: lxml if it is installed, as it is much faster
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+HTML_PARSER = os.environ.get("MENU_HTML_PARSER", HTML_PARSER)
+
+_PREFETCHED = threading.local()
+
+
+def restaurant_info(res_data: dict) -> dict:
+    """
+    The basic information about a restaurant, without any menu
+    """
+    return {
+        "title": res_data["name"],
+        "location": res_data["region"],
+        "url": res_data["homepage"],
+        "map_url": res_data["gmaps"],
+    }
+
 
 def restaurant(func):
     """
     Decorator to use for restaurants.
-    """
 
-    def helper(res_data):
-        data = {
-            "title": res_data["name"],
-            "location": res_data["region"],
-            "url": res_data["homepage"],
-            "map_url": res_data["gmaps"],
-        }
-        try:
-            data.update(func(res_data))
-        except Exception as err:
-            sys.stderr.write(f"E in {func.__name__}: {err}\n")
-            data.update({"menu": []})
-            pass
+    The decorated function is given the restaurant data and the DateContext of the day to
+    get the menu for. The returned function takes the context as an optional argument
+    (default today).
+    """
+
+    def helper(res_data, dates: DateContext = None):
+        dates = dates or DateContext.today()
+        data = restaurant_info(res_data)
+        with metrics.record(res_data["identifier"]) as call:
+            try:
+                data.update(func(res_data, dates))
+            except Exception as err:
+                sys.stderr.write(f"E in {func.__name__}: {err}\n")
+                metrics.set_error(err)
+                data.update({"menu": []})
+            call.dishes = len(data["menu"])
         return data
 
     helper.__name__ = func.__name__
     helper.__doc__ = func.__doc__
+    helper.checks_week = getattr(func, "checks_week", False)
 
     return helper
 
 
-def get_parser(url: str) -> BeautifulSoup:
+def week_menu(only: tuple = None, features: str = None, checks_week: bool = False):
     """
-    Request page and create Beautifulsoup object
-    """
-    browser = {"browser": "chrome", "mobile": False, "platform": "windows"}
-    scraper = cloudscraper.create_scraper(browser=browser)
-    page_req = scraper.get(url)
-    if page_req.status_code != 200:
-        raise IOError("Url " + str(url) + " Bad HTTP response code: " + str(page_req.status_code) + " " +page_req.text)
-    return BeautifulSoup(page_req.text, "html.parser")
+    Decorator to use for restaurants with the menu for the whole week on one page.
 
+    The decorated function is given the parsed page, a weekday digit (monday = 0) and the
+    DateContext, and returns the dishes for that day. The page is only downloaded once,
+    and the menus of all weekdays are included under "week", keyed by ISO date.
 
-def fix_bad_symbols(text):
-    """
-    HTML formatting of characters
+    Args:
+        only (tuple): Arguments for a SoupStrainer selecting the part of the page to parse.
+        features (str): The tree builder to use, if not the default one.
+        checks_week (bool): The function only returns dishes if the page shows the week of
+            the DateContext, so the menus of the later days can be trusted on their day.
     """
-    text = text.replace("Ã¨", "è")
-    text = text.replace("Ã¤", "ä")
-    text = text.replace("Ã", "Ä")
-    text = text.replace("Ã", "Ä")
-    text = text.replace("Ã¶", "ö")
-    text = text.replace("Ã©", "é")
-    text = text.replace("Ã¥", "å")
-    text = text.replace("Ã", "Å")
 
-    text = text.strip()
+    def decorator(func):
+        def helper(res_data, dates):
+            soup = get_parser(res_data["menuUrl"], only=only, features=features)
+            return parse_week(soup, func, dates)
 
-    return text
+        helper.__name__ = func.__name__
+        helper.__doc__ = func.__doc__
+        helper.checks_week = checks_week
 
+        return helper
 
-### date management start ###
-def get_day():
-    """
-    Today as digit
-    """
-    return date.today().day
+    return decorator
 
 
-def get_monthdigit():
+def parse_week(soup, func, dates: "DateContext") -> dict:
     """
-    Month as digit
+    Get the dishes of every weekday in the week of dates using func(soup, wdigit, dates)
+
+    Returns the menu of the day of dates and, under "week", the menus of all weekdays
+    keyed by ISO date.
     """
-    return date.today().month
+    week = {}
+    for wdigit in range(5):
+        try:
+            menu = func(soup, wdigit, dates)
+        except Exception as err:
+            sys.stderr.write(f"E in {func.__name__} for {dates.weekday(wdigit=wdigit)}: {err}\n")
+            if wdigit == dates.weekdigit:
+                metrics.set_error(err)
+            menu = []
+        week[dates.date_of(wdigit).isoformat()] = menu
+    return {"menu": week.get(dates.day.isoformat(), []), "week": week}
 
 
-def get_month():
+def layout_menu(res_data: dict, layout: dict, dates: "DateContext") -> dict:
     """
-    Month name
+    Parse a page with the menu for the whole week using a layout (see layouts.py)
     """
-    months = {
-        1: "januari",
-        2: "februari",
-        3: "mars",
-        4: "april",
-        5: "maj",
-        6: "juni",
-        7: "juli",
-        8: "augusti",
-        9: "september",
-        10: "oktober",
-        11: "november",
-        12: "december",
-    }
+    import layouts  # pylint: disable=import-outside-toplevel
 
-    return months[get_monthdigit()]
+    extractor = layouts.compile_layout(layout)
+    only = None
+    if extractor.only:
+        attrs = {key: has_class(value) if key == "class" else value
+                 for key, value in extractor.only.items() if key != "tag"}
+        only = (extractor.only.get("tag"), attrs)
+    soup = get_parser(res_data["menuUrl"], only=only)
 
+    def extract(soup, wdigit, dates):
+        return extractor.extract(soup, wdigit, dates.weekday(lang=extractor.lang, wdigit=wdigit))
 
-def get_week():
+    extract.__name__ = f"{res_data['identifier']} layout"
+    return parse_week(soup, extract, dates)
+
+
+@contextlib.contextmanager
+def prefetched(pages: dict):
     """
-    Week number
+    Let get_page use pages that have already been downloaded, in the current thread
+
+    Args:
+        pages (dict): For each url, a tuple of the page text (or the exception raised
+            when downloading it) and the seconds the download took.
     """
-    return date.today().isocalendar()[1]
+    _PREFETCHED.pages = pages
+    try:
+        yield
+    finally:
+        _PREFETCHED.pages = None
+
+
+def get_page(url: str) -> str:
+    """
+    Request page, reusing the stored copy if the server says it has not changed
+    """
+    pages = getattr(_PREFETCHED, "pages", None)
+    if pages and url in pages:
+        page, seconds = pages[url]
+        if isinstance(page, Exception):
+            metrics.add_fetch(seconds, 0, None, before=True)
+            raise page
+        metrics.add_fetch(seconds, len(page.encode()), 200, before=True)
+        return page
+    stored = storage.get_page(url)
+    headers = {}
+    if stored and stored["etag"]:
+        headers["If-None-Match"] = stored["etag"]
+    if stored and stored["last_modified"]:
+        headers["If-Modified-Since"] = stored["last_modified"]
+    start = time.perf_counter()
+    try:
+        page_req = session.get(url, headers=headers)
+    except Exception:
+        metrics.add_fetch(time.perf_counter() - start, 0, None)
+        raise
+    metrics.add_fetch(time.perf_counter() - start, len(page_req.content), page_req.status_code)
+    if page_req.status_code == 304 and stored:
+        return stored["body"]
+    if page_req.status_code != 200:
+        raise IOError("Url " + str(url) + " Bad HTTP response code: " + str(page_req.status_code) + " " +page_req.text)
+    etag = page_req.headers.get("ETag")
+    last_modified = page_req.headers.get("Last-Modified")
+    if etag or last_modified:
+        storage.put_page(url, etag, last_modified, page_req.text)
+    return page_req.text
 
 
-def get_weekday(lang="sv", tomorrow=False):
+def has_class(name: str):
     """
-    Day name in swedish(sv) or english (en)
+    Match a tag with the class among its classes
+
+    Needed for SoupStrainers, as they see the full class attribute while the page is parsed.
     """
-    wdigit = get_weekdigit()
-    if tomorrow:
-        wdigit += 1
-    if lang == "sv":
-        weekdays = {
-            0: "måndag",
-            1: "tisdag",
-            2: "onsdag",
-            3: "torsdag",
-            4: "fredag",
-            5: "lördag",
-            6: "söndag",
-            7: "måndag",
-        }
-    if lang == "en":
-        weekdays = {
-            0: "monday",
-            1: "tuesday",
-            2: "wednesday",
-            3: "thursday",
-            4: "friday",
-            5: "saturday",
-            6: "sunday",
-            7: "monday",
-        }
-    return weekdays[wdigit]
+    return re.compile(r"(^|\s)" + re.escape(name) + r"($|\s)")
 
 
-def get_weekdigit():
+def get_parser(url: str, only: tuple = None, features: str = None):
     """
-    Get digit for week (monday = 0)
+    Request page and create Beautifulsoup object
+
+    Args:
+        url (str): The page to request.
+        only (tuple): Arguments for a SoupStrainer, to only build the tree for the matching
+            tags (and their contents) instead of the whole page.
+        features (str): The tree builder to use (default HTML_PARSER).
     """
-    return date.today().weekday()
+    from bs4 import BeautifulSoup, SoupStrainer  # pylint: disable=import-outside-toplevel
+
+    parse_only = SoupStrainer(*only) if only else None
+    return BeautifulSoup(get_page(url), features or HTML_PARSER, parse_only=parse_only)
 
 
-def get_year():
+def fix_bad_symbols(text):
     """
-    Year as number
+    HTML formatting of characters
     """
-    return date.today().year
+    text = text.replace("Ã¨", "è")
+    text = text.replace("Ã¤", "ä")
+    text = text.replace("Ã", "Ä")
+    text = text.replace("Ã", "Ä")
+    text = text.replace("Ã¶", "ö")
+    text = text.replace("Ã©", "é")
+    text = text.replace("Ã¥", "å")
+    text = text.replace("Ã", "Å")
+
+    text = text.strip()
+
+    return text
+
+
+### date management start ###
+WEEKDAYS = {
+    "sv": ("måndag", "tisdag", "onsdag", "torsdag", "fredag", "lördag", "söndag"),
+    "en": ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"),
+}
+
+MONTHS = (
+    "januari", "februari", "mars", "april", "maj", "juni",
+    "juli", "augusti", "september", "oktober", "november", "december",
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class DateContext:
+    """
+    The day to get the menus for, with the names and numbers the parsers need
+
+    Built once per run and given to every parser, so they all use the same day, also if
+    the run passes midnight, and menus can be fetched for another day than today.
+    """
+
+    day: date
+    weekdigit: int  # monday = 0
+    week: int  # ISO week number
+    year: int  # ISO year
+    month: str  # swedish name
+    weekday_sv: str
+    weekday_en: str
+
+    @classmethod
+    def for_day(cls, day: date) -> "DateContext":
+        """
+        The context for a day
+        """
+        year, week, _ = day.isocalendar()
+        return cls(
+            day=day,
+            weekdigit=day.weekday(),
+            week=week,
+            year=year,
+            month=MONTHS[day.month - 1],
+            weekday_sv=WEEKDAYS["sv"][day.weekday()],
+            weekday_en=WEEKDAYS["en"][day.weekday()],
+        )
+
+    @classmethod
+    def today(cls) -> "DateContext":
+        """
+        The context for today in Stockholm
+        """
+        return cls.for_day(storage.today())
+
+    def weekday(self, lang: str = "sv", wdigit: int = None, tomorrow: bool = False) -> str:
+        """
+        Day name in swedish (sv) or english (en)
+
+        The day of the context, unless another weekday digit (monday = 0) is given.
+        """
+        if wdigit is None:
+            wdigit = self.weekdigit
+        if tomorrow:
+            wdigit += 1
+        return WEEKDAYS[lang][wdigit % 7]
+
+    def date_of(self, wdigit: int) -> date:
+        """
+        Date of a weekday (monday = 0) in the week of the context
+        """
+        return self.day + datetime.timedelta(days=wdigit - self.weekdigit)
 
 
 ### date management end ###
 
 ### parsers start ###
 @restaurant
-def parse_bikupan(res_data: dict) -> dict:
+@week_menu(only=("div", {"id": "current"}), checks_week=True)
+def parse_bikupan(soup, wdigit: int, dates: DateContext) -> list:
     """
     Parse the menu of Restaurang Bikupan
     """
-
-    def fmt_paragraph(p):
-        return p.get_text().strip().replace("\n", " ")
-
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    menu = []
     # check week number
     target = soup.find("div", {"id": "current"})
-    if str(get_week()) not in target.find("h2").text:
-        return data
-    raw_menu = target.find("div", {"class": "menu-item " + get_weekday(lang="en")})
+    if str(dates.week) not in target.find("h2").text:
+        return menu
+    raw_menu = target.find("div", {"class": "menu-item " + dates.weekday(lang="en", wdigit=wdigit)})
     for entry in raw_menu.find_all("p"):
         # skip rows with english
         if "class" in entry.attrs and "eng-meny" in entry.attrs["class"]:
             continue
-        data["menu"].append(entry.text.strip())
+        menu.append(entry.text.strip())
 
-    return data
+    return menu
 
 
 @restaurant
-def parse_dufva(res_data):
+def parse_dufva(res_data, dates):
     """
     Parse the menu of Sven Dufva
     """
     data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    soup = get_parser(res_data["menuUrl"], only=("div", {"id": "post"}))
 
     relevant = soup.find("div", {"id": "post"})
     menu_data = relevant.get_text().split("\n")
-    dag = get_weekday()
+    dag = dates.weekday_sv
     started = False
     for line in menu_data:
         if not line:
@@ -244,7 +387,7 @@ def parse_dufva(res_data):
 
 
 @restaurant
-def parse_glada(res_data):
+def parse_glada(res_data, dates):
     """
     Parse the menu of Glada restaurangen
     """
@@ -254,7 +397,7 @@ def parse_glada(res_data):
 
 
 @restaurant
-def parse_haga(res_data):
+def parse_haga(res_data, dates):
     """
     Print a link to the menu of Haga gatukök
     """
@@ -262,7 +405,7 @@ def parse_haga(res_data):
 
 
 @restaurant
-def parse_hjulet(res_data):
+def parse_hjulet(res_data, dates):
     """
     Parse the menu of Restaurang Hjulet.
 
@@ -273,32 +416,30 @@ def parse_hjulet(res_data):
     return data
 
 
+HUBBEN_LAYOUT = {
+    "template": "day-blocks",
+    "only": {"tag": "div", "class": "day"},
+    "days": "div.day",
+    "dishes": "div.element.description.col-md-4.col-print-5",
+    "single_line": True,
+}
+
+
 @restaurant
-def parse_hubben(res_data):
+def parse_hubben(res_data, dates):
     """
     Parse the menu of Restaurang Hubben
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
-
-    days = soup.find_all("div", {"class": "day"})
-    current = days[get_weekdigit()]
-    dishes = current.find_all(
-        "div", {"class": "element description col-md-4 col-print-5"}
-    )
-    for dish in dishes:
-        data["menu"].append(dish.get_text().strip().replace("\n", " "))
-
-    return data
+    return layout_menu(res_data, HUBBEN_LAYOUT, dates)
 
 
 @restaurant
-def parse_jons(res_data):
+def parse_jons(res_data, dates):
     """
     Parse the menu of Jöns Jacob
     """
     data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    soup = get_parser(res_data["menuUrl"], only=("table", {"class": has_class("lunch_menu")}))
 
     days = soup.find("table", {"class": "table lunch_menu animation"})
     day = days.find("tbody", {"class": "lunch-day-content"})
@@ -309,7 +450,7 @@ def parse_jons(res_data):
 
 
 @restaurant
-def parse_jorpes(res_data):
+def parse_jorpes(res_data, dates):
     """
     Parse the menu of Resturang Jorpes
     """
@@ -318,17 +459,17 @@ def parse_jorpes(res_data):
 
 
 @restaurant
-def parse_livet(res_data):
+def parse_livet(res_data, dates):
     """
     Parse the menu of Livet
     """
     data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    soup = get_parser(res_data["menuUrl"], only=(("h3", "p"),))
 
     started = False
     for par in soup.find_all(("h3", "p")):
         if started:
-            if par.find(text=re.compile(get_weekday(tomorrow=True).capitalize())):
+            if par.find(text=re.compile(dates.weekday(tomorrow=True).capitalize())):
                 break
             if par.find(text=re.compile("[Pp]ersonuppgifterna")):
                 break
@@ -336,23 +477,23 @@ def parse_livet(res_data):
             if text:
                 data["menu"].append(text)
             continue
-        if par.find(text=re.compile(get_weekday().capitalize())):
+        if par.find(text=re.compile(dates.weekday_sv.capitalize())):
             started = True
 
     return data
 
 
 @restaurant
-def parse_nanna(res_data):
+def parse_nanna(res_data, dates):
     """Parse the menu of Nanna Svartz."""
     data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    soup = get_parser(res_data["menuUrl"], only=("article", {"class": has_class("article")}))
 
     menu_part = soup.find("article", {"class": "article"}).find("div", {"class": "text"})
-    if not menu_part.find("h2").find(text=re.compile(r"MATSEDEL V\." + str(get_week()))):
+    if not menu_part.find("h2").find(text=re.compile(r"MATSEDEL V\." + str(dates.week))):
         return data
 
-    day = f"{get_weekday().capitalize()} {str(get_day())} {get_month()}"
+    day = f"{dates.weekday_sv.capitalize()} {dates.day.day} {dates.month}"
     current_day = False
     for tag in menu_part.find_all(("ul", "strong")):
         if current_day:
@@ -369,24 +510,26 @@ def parse_nanna(res_data):
 
     return data
 
+# the same layout is used by Bistro Rudbeck and Tallriket
+RUDBECK_LAYOUT = {
+    "template": "day-blocks",
+    "only": {"tag": "div", "class": "container-fluid no-print"},
+    "days": "div.container-fluid.no-print",
+    "dishes": "span",
+    "skip": 3,
+}
+
+
 @restaurant
-def parse_rudbeck(res_data):
+def parse_rudbeck(res_data, dates):
     """
     Parse the menu of Bistro Rudbeck
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
-
-    days = soup.find_all("div", {"class": "container-fluid no-print"})
-    day = days[get_weekdigit()]
-    dishes = day.find_all("span")[3:]
-    for dish in dishes:
-        data["menu"].append(dish.get_text().strip())
+    return layout_menu(res_data, RUDBECK_LAYOUT, dates)
 
-    return data
 
 @restaurant
-def parse_svarta(res_data):
+def parse_svarta(res_data, dates):
     """
     Parse the menu of Svarta Räfven
     """
@@ -394,103 +537,82 @@ def parse_svarta(res_data):
 
 
 @restaurant
-def parse_tallrik(res_data):
+def parse_tallrik(res_data, dates):
     """
     Parse the menu of Tallriket
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    return layout_menu(res_data, dict(RUDBECK_LAYOUT, min_length=1), dates)
 
-    days = soup.find_all("div", {"class": "container-fluid no-print"})
-    day = days[get_weekdigit()]
-    dishes = day.find_all("span")[3:]
-    for dish in [x for x in dishes if x.get_text().strip() != ""]:
-        data["menu"].append(dish.get_text().strip())
-
-    return data
 
 @restaurant
-def parse_kvartersmenyn(res_data):
+@week_menu(only=("div", {"class": has_class("meny")}))
+def parse_kvartersmenyn(soup, wdigit, dates):
     """
     Parse the menus on kvartersmenyn.se
     """
-    try:
-        data = {"menu": []}
-        soup = get_parser(res_data["menuUrl"])
-
-        menu = soup.find("div", {"class": "meny"})
-        day = False
-        for line in menu.contents:
-            if day:
-                if line.name is not None:
-                    if "br" in line.name:
-                        continue
-                    if "strong" in line.name or "b" in line.name:
-                        day=False
-                        break
-                data["menu"].append(line.string)
-            if line.string is not None and get_weekday().lower() in line.string.lower():
-                day = True
-    except Exception as e:
-        print(res_data, file=sys.stderr)
-        print(soup, file=sys.stderr)
-        print(e, file=sys.stderr)
-    return data
+    dishes = []
+
+    menu = soup.find("div", {"class": "meny"})
+    day = False
+    for line in menu.contents:
+        if day:
+            if line.name is not None:
+                if "br" in line.name:
+                    continue
+                if "strong" in line.name or "b" in line.name:
+                    day=False
+                    break
+            dishes.append(line.string)
+        if line.string is not None and dates.weekday(wdigit=wdigit) in line.string.lower():
+            day = True
+    return dishes
 
 
 @restaurant
-def parse_nordicforum(res_data):
+@week_menu(only=("table", {"class": has_class("lunch_menu")}))
+def parse_nordicforum(soup, wdigit, dates):
     """
     Parse the menu of nordic forum
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    dishes = []
 
     menu = soup.find("table", {"class": "lunch_menu"})
     itr = iter(menu.children)
     for child in itr:
         if child.name == "thead":
-            if get_weekday().capitalize() in child.find("h3").string:
+            if dates.weekday(wdigit=wdigit).capitalize() in child.find("h3").string:
                 next(itr)
                 for item in next(itr):
                     if item.name:
-                        data["menu"].append(item.find("td", {"class": "td_title"}).text.strip())
+                        dishes.append(item.find("td", {"class": "td_title"}).text.strip())
 
-    return data
+    return dishes
 
 @restaurant
-def parse_tastorykista(res_data):
+@week_menu(only=("channel",), features="html.parser")
+def parse_tastorykista(soup, wdigit, dates):
     """
     Parse the menu of tastory kista
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
+    from bs4 import BeautifulSoup  # pylint: disable=import-outside-toplevel
+
+    dishes = []
     menu = soup.find("channel")
     for child in menu.find_all("item"):
-        if get_weekday().capitalize() in child.find("title").string:
+        if dates.weekday(wdigit=wdigit).capitalize() in child.find("title").string:
             day = BeautifulSoup(child.find("description").string, "html.parser")
             for dish in day.find_all("p"):
                 if dish.string != " ":
                     dish_string = next(dish.stripped_strings)
                     if "ändringar" not in dish_string and "Till dagens" not in dish_string and dish_string != " ":
-                        data["menu"].append(dish_string)
+                        dishes.append(dish_string)
 
-    return data
+    return dishes
 
 
 @restaurant
-def parse_glaze(res_data):
+def parse_layout(res_data, dates):
     """
-    Parse the menu of glaze
+    Parse the menu of a restaurant with a "layout" in restaurants.json
     """
-    data = {"menu": []}
-    soup = get_parser(res_data["menuUrl"])
-
-    menu = soup.find("div", {"class", "week-container"})
-    for day in menu.find_all("div", {"class", "day"}):
-        if get_weekday().capitalize() in day.find("h2"):
-            for dish in day.find_all("div", {"class", "title"}):
-                if len(dish.text.strip()) > 1:
-                    data["menu"].append(dish.text.strip())
-            break
-    return data
+    return layout_menu(res_data, res_data["layout"], dates)
@@ -0,0 +1,88 @@
+"""
+The restaurants in restaurants.json, with indexes for looking them up.
+
+A Registry is built once for each version of the file and is never modified, so it can
+be shared by reference between threads. get() returns the current one, and loads the file
+again when it has changed on disk (checked at most every CHECK_INTERVAL seconds), so
+restaurants can be added without a restart.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from types import MappingProxyType
+
+import session
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+REST_FILENAME = os.path.join(__location__, "restaurants.json")
+
+CHECK_INTERVAL = float(os.environ.get("MENU_REGISTRY_CHECK", 2))
+
+_REGISTRY = None
+_VERSION = None
+_CHECKED = 0.0
+_LOCK = threading.Lock()
+
+
+class Registry:
+    """
+    The restaurants of one version of restaurants.json
+
+    Attributes:
+        version: The modification time (ns) of the file it was loaded from.
+        restaurants: The restaurant entries, keyed by identifier, in the order of the file.
+        entries: The restaurant entries as a tuple.
+        by_region: The identifiers of the restaurants in each region (lower case).
+        by_site: The identifiers of the restaurants on each site (see session.get_site).
+    """
+
+    def __init__(self, entries: list, version: int = 0):
+        restaurants = {entry["identifier"]: entry for entry in entries}
+        regions = {}
+        sites = {}
+        for name, entry in restaurants.items():
+            regions.setdefault(entry["region"].lower(), []).append(name)
+            sites.setdefault(session.get_site(entry["menuUrl"]), []).append(name)
+        self.version = version
+        self.restaurants = MappingProxyType(restaurants)
+        self.entries = tuple(restaurants.values())
+        self.by_region = MappingProxyType({region: tuple(names) for region, names in regions.items()})
+        self.by_site = MappingProxyType({site: tuple(names) for site, names in sites.items()})
+
+
+def read_restaurants(intext: str, version: int = 0) -> Registry:
+    """
+    Parse the list of restaurants from the restaurants file.
+
+    Args:
+        intext(str): The text loaded from the restaurants file.
+        version(int): The modification time of the file.
+    """
+    return Registry(json.loads(intext)["restaurants"], version)
+
+
+def get() -> Registry:
+    """
+    Get the current registry, loading restaurants.json again if it has changed
+
+    If the changed file cannot be read (or is missing), the previous registry is kept
+    until it changes again.
+    """
+    global _REGISTRY, _VERSION, _CHECKED
+    if _REGISTRY is None or time.monotonic() - _CHECKED > CHECK_INTERVAL:
+        with _LOCK:
+            if _REGISTRY is None or time.monotonic() - _CHECKED > CHECK_INTERVAL:
+                _CHECKED = time.monotonic()
+                try:
+                    version = os.stat(REST_FILENAME).st_mtime_ns
+                    if _REGISTRY is None or version != _VERSION:
+                        _VERSION = version
+                        with open(REST_FILENAME) as infile:
+                            _REGISTRY = read_restaurants(infile.read(), version)
+                except (OSError, ValueError, KeyError) as err:
+                    if _REGISTRY is None:
+                        raise
+                    sys.stderr.write(f"E in reading {REST_FILENAME}: {err}\n")
+    return _REGISTRY
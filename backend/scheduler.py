@@ -0,0 +1,64 @@
+"""
+Background warming of the stored menus.
+
+The menus of all restaurants are fetched at a set time each weekday, so requests are
+served from the storage. Only one process on the host runs the warming, which is
+decided by a lock file next to the database.
+"""
+import fcntl
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import main
+import storage
+
+LOCK_FILENAME = storage.DB_FILENAME + ".warm.lock"
+
+_LOCK_FILE = None
+
+
+def next_run(at: str, now: datetime) -> datetime:
+    """
+    The next weekday time (HH:MM, Stockholm time) after now
+    """
+    hour, minute = (int(part) for part in at.split(":"))
+    run = now.astimezone(storage.TIMEZONE).replace(tzinfo=None, hour=hour, minute=minute, second=0, microsecond=0)
+    while run <= now.astimezone(storage.TIMEZONE).replace(tzinfo=None) or run.weekday() >= 5:
+        run += timedelta(days=1)
+    return storage.TIMEZONE.localize(run)
+
+
+def _run(at: str):
+    """
+    Warm the menus at the given time every weekday
+    """
+    while True:
+        now = datetime.now(storage.TIMEZONE)
+        time.sleep((next_run(at, now) - now).total_seconds())
+        try:
+            main.warm()
+        except Exception as err:
+            sys.stderr.write(f"E in warming: {err}\n")
+
+
+def start(at: str) -> bool:
+    """
+    Start warming the menus at the given time (HH:MM) every weekday
+
+    Returns False if the warming is already run by another process.
+    """
+    global _LOCK_FILE
+    # fail early on a bad time
+    next_run(at, datetime.now(storage.TIMEZONE))
+    lock_file = open(LOCK_FILENAME, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # keep the file (and thereby the lock) for the lifetime of the process
+    _LOCK_FILE = lock_file
+    threading.Thread(target=_run, args=(at,), daemon=True, name="menu-warming").start()
+    return True
@@ -0,0 +1,191 @@
+"""
+Shared HTTP session used to download the restaurant pages.
+
+One cloudscraper session is created per process, and each thread uses its own shallow
+copy of it. The copies share the connection pools (the mounted adapters), the cookies and
+the headers, so connections and solved Cloudflare challenges are reused between fetches,
+also across restaurants on the same host, while the challenge state of cloudscraper (the
+loop protection counter) is kept per thread, so concurrent challenges do not trip each
+other.
+
+The requests are also spread out per site (the registered domain, so all kvartersmenyn.se
+restaurants count as one site): at most HOST_CONCURRENCY requests at a time, started at
+least HOST_INTERVAL seconds apart. Responses with 429 (or 503 with Retry-After) are
+retried after the time asked for, during which no other requests are sent to the site.
+
+cloudscraper and requests are only imported when the session is created, as they take
+long to import.
+"""
+import copy
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+BROWSER = {"browser": "chrome", "mobile": False, "platform": "windows"}
+
+# number of hosts to keep connection pools for, and connections per host
+POOL_HOSTS = int(os.environ.get("MENU_POOL_HOSTS", 16))
+POOL_SIZE = int(os.environ.get("MENU_POOL_SIZE", 4))
+
+CONNECT_TIMEOUT = float(os.environ.get("MENU_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("MENU_READ_TIMEOUT", 20))
+
+# 503 is left to cloudscraper, as that is what Cloudflare uses for its challenges
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUS = (500, 502, 504)
+
+# requests per site at the same time, seconds between their starts, and the longest
+# Retry-After to wait for (longer ones are given up on)
+HOST_CONCURRENCY = int(os.environ.get("MENU_HOST_CONCURRENCY", 2))
+HOST_INTERVAL = float(os.environ.get("MENU_HOST_INTERVAL", 0.5))
+MAX_RETRY_AFTER = float(os.environ.get("MENU_MAX_RETRY_AFTER", 30))
+
+_SESSION = None
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_LIMITERS = {}
+
+
+class HostLimiter:
+    """
+    Concurrency and rate limit for the requests to one site
+    """
+
+    def __init__(self):
+        self.semaphore = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait_turn(self):
+        """
+        Sleep until the next free start time for a request, and reserve it
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + HOST_INTERVAL
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds: float):
+        """
+        Start no requests to the site for the given time
+        """
+        with self._lock:
+            self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+def create_session():
+    """
+    Create a scraper (cloudscraper.CloudScraper) with pooled connections and retries
+    """
+    # pylint: disable=import-outside-toplevel
+    import cloudscraper
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    scraper = cloudscraper.create_scraper(browser=BROWSER)
+    retries = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+        # Retry-After is handled in get, with a limit on the wait
+        respect_retry_after_header=False,
+    )
+    # keep the cipher suite adapter from cloudscraper, only resize its pools
+    https = scraper.get_adapter("https://")
+    https.max_retries = retries
+    https.init_poolmanager(POOL_HOSTS, POOL_SIZE, block=True)
+    scraper.mount(
+        "http://",
+        HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, pool_block=True, max_retries=retries),
+    )
+    return scraper
+
+
+def get_session():
+    """
+    Get the session of the current thread, creating the shared one on first use
+
+    The session of a thread is a shallow copy of the shared one: the adapters (and their
+    pools), cookies and headers are the same objects, the per-request state is its own.
+    """
+    global _SESSION
+    scraper = getattr(_LOCAL, "session", None)
+    if scraper is None:
+        if _SESSION is None:
+            with _LOCK:
+                if _SESSION is None:
+                    _SESSION = create_session()
+        scraper = _LOCAL.session = copy.copy(_SESSION)
+        scraper._solveDepthCnt = 0  # pylint: disable=protected-access
+    return scraper
+
+
+def get_site(url: str) -> str:
+    """
+    The site of a url: the last two parts of the host name (or the whole IP address)
+    """
+    host = urlsplit(url).hostname or ""
+    if host.replace(".", "").isdigit():
+        return host
+    return ".".join(host.split(".")[-2:])
+
+
+def get_limiter(url: str) -> HostLimiter:
+    """
+    Get the limiter for the site of a url
+    """
+    with _LOCK:
+        return _LIMITERS.setdefault(get_site(url), HostLimiter())
+
+
+def retry_after(response) -> float:
+    """
+    Seconds to wait according to the Retry-After header of a response, or None if not given
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get(url: str, **kwargs):
+    """
+    GET a url using the shared session, within the limits for its site
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    limiter = get_limiter(url)
+    for attempt in range(RETRIES + 1):
+        with limiter.semaphore:
+            limiter.wait_turn()
+            response = get_session().get(url, **kwargs)
+        if response.status_code == 429:
+            delay = retry_after(response)
+            if delay is None:
+                delay = BACKOFF * 2 ** attempt
+        elif response.status_code == 503:
+            # without Retry-After it is a Cloudflare challenge cloudscraper could not solve
+            delay = retry_after(response)
+            if delay is None:
+                return response
+        else:
+            return response
+        if delay > MAX_RETRY_AFTER or attempt == RETRIES:
+            limiter.pause(min(delay, MAX_RETRY_AFTER))
+            return response
+        limiter.pause(delay)
+    return response
@@ -0,0 +1,42 @@
+"""
+Coalescing of concurrent identical calls.
+"""
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Run a function only once for concurrent calls with the same key
+
+    The first caller runs the function, and callers arriving while it is running wait for
+    it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args):
+        """
+        Call func(*args), unless a call with the same key is already in progress
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args)
+        except BaseException as err:
+            call.set_exception(err)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result
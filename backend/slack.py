@@ -2,63 +2,97 @@
 Requests/functions used to interact with slack
 """
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import flask
 
 import main
+import registry
 
 
 blueprint = flask.Blueprint("slack", __name__)  # pylint: disable=invalid-name
 
 
+# seconds to wait for the menus before answering, Slack allows at most 3
+RESPONSE_BUDGET = float(os.environ.get("SLACK_RESPONSE_BUDGET", 2.5))
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="slack")
+
+
 @blueprint.route("/", methods=["POST"])
 def handle_slack_command():
     command_text = flask.request.form["text"]
     identifiers = command_text.split()
-    available = [entry["identifier"] for entry in main.list_restaurants()]
-    regions = ("ki", "bmc", "uu", "uppsala", "solna")
+    current = registry.get()
 
-    text = ""
+    wanted = []
     for identifier in identifiers:
-        if identifier in available:
-            restaurant_data = dict(main.get_restaurant(identifier))
-            text += f'*{restaurant_data["title"]}*\n'
-            for dish in restaurant_data["menu"]:
-                text += f"- {dish}\n"
-        elif identifier.lower() in regions:
-            if identifier.lower() in ("solna", "ki"):
-                new_ids = [
-                    entry["identifier"]
-                    for entry in main.list_restaurants()
-                    if entry["campus"] == "Solna"
-                ]
-            else:
-                new_ids = [
-                    entry["identifier"]
-                    for entry in main.list_restaurants()
-                    if entry["campus"] == "Uppsala"
-                ]
-            for ident in new_ids:
-                restaurant_data = dict(main.get_restaurant(ident))
-                text += f'*{restaurant_data["title"]}*\n'
-                for dish in restaurant_data["menu"]:
-                    text += f"- {dish}\n"
+        if identifier in current.restaurants:
+            wanted.append(identifier)
+        elif identifier.lower() in current.by_region:
+            wanted += current.by_region[identifier.lower()]
         else:
-            text = list_identifiers()
+            wanted = []
             break
-    if not identifiers:
-        text = list_identifiers()
+    if not wanted:
+        return flask.jsonify(make_response(list_identifiers()))
 
-    response = {
+    # fetch all restaurants concurrently, and post the menus later if it takes too long
+    future = _EXECUTOR.submit(main.get_menus, wanted)
+    response_url = flask.request.form.get("response_url")
+    try:
+        menus = future.result(timeout=RESPONSE_BUDGET if response_url else None)
+    except TimeoutError:
+        future.add_done_callback(lambda done: post_menus(response_url, done))
+        return flask.jsonify({"response_type": "ephemeral", "text": "Fetching the menus..."})
+    return flask.jsonify(make_response(format_menus(menus)))
+
+
+def make_response(text: str) -> dict:
+    return {
         "blocks": [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
     }
-    return flask.jsonify(response)
+
+
+def format_menus(menus: dict) -> str:
+    text = ""
+    for restaurant_data in menus.values():
+        text += f'*{restaurant_data["title"]}*\n'
+        for dish in restaurant_data["menu"]:
+            text += f"- {dish}\n"
+    return text
+
+
+def post_menus(response_url: str, done):
+    """
+    Send the menus of a finished fetch as a delayed response, or an error if it failed
+    """
+    err = done.exception()
+    if err is not None:
+        sys.stderr.write(f"E in fetching the menus for Slack: {err}\n")
+        post_response(response_url, make_response("Could not fetch the menus, please try again later."))
+    else:
+        post_response(response_url, make_response(format_menus(done.result())))
+
+
+def post_response(response_url: str, response: dict):
+    """
+    Send a delayed response to the response_url of a command
+    """
+    import requests  # pylint: disable=import-outside-toplevel
+
+    try:
+        requests.post(response_url, json=response, timeout=10)
+    except requests.RequestException as err:
+        sys.stderr.write(f"E in posting to Slack: {err}\n")
 
 
 def list_identifiers() -> str:
+    current = registry.get()
     text = f"*Available restaurants:*\n"
-    for entry in main.list_restaurants():
+    for entry in current.entries:
         text += f'- {entry["name"]}: `{entry["identifier"]}`\n'
-    text += "- Solna: `solna`\n"
-    text += "- Uppsala: `uppsala`\n"
+    for region, names in current.by_region.items():
+        text += f'- {current.restaurants[names[0]]["region"]}: `{region}`\n'
     return text
@@ -0,0 +1,348 @@
+"""
+Local storage of parsed menus, downloaded pages and rendered HTML.
+
+The data is kept in an SQLite database, so it survives restarts and is shared
+between all processes (e.g. gunicorn workers) on the host. A menu is stored for the
+date it is valid, in Stockholm time, and is not used after that day has passed.
+
+All stored dishes are also kept in an archive, which is never cleaned up, with a
+full-text index for searching them.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+
+import pytz
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+DB_FILENAME = os.environ.get("MENU_DB", os.path.join(__location__, "menus.sqlite"))
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS menus (
+    identifier TEXT NOT NULL,
+    day TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (identifier, day)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    body TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fragments (
+    identifier TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    html TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS builds (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    identifier TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    retry_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive (
+    identifier TEXT NOT NULL,
+    day TEXT NOT NULL,
+    dish TEXT NOT NULL,
+    UNIQUE (identifier, day, dish)
+);
+CREATE TABLE IF NOT EXISTS circuits (
+    identifier TEXT PRIMARY KEY,
+    errors INTEGER NOT NULL,
+    error TEXT,
+    open_until REAL
+);
+"""
+
+# the trigram tokenizer (SQLite 3.34+) also finds words within compound words,
+# e.g. falafel in kycklingfalafel
+ARCHIVE_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS archive_index USING fts5(dish, content='archive', tokenize='{}');
+CREATE TRIGGER IF NOT EXISTS archive_insert AFTER INSERT ON archive BEGIN
+    INSERT INTO archive_index (rowid, dish) VALUES (new.rowid, new.dish);
+END;
+"""
+
+_LOCAL = threading.local()
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Get the database connection of the current thread
+    """
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILENAME, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        try:
+            conn.executescript(ARCHIVE_INDEX.format("trigram"))
+        except sqlite3.OperationalError:
+            conn.executescript(ARCHIVE_INDEX.format("unicode61"))
+        _LOCAL.conn = conn
+    return conn
+
+
+@contextlib.contextmanager
+def lock(name: str):
+    """
+    Hold an exclusive lock, shared by all processes using the database
+    """
+    with open(f"{DB_FILENAME}.{name}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def today() -> date:
+    """
+    The current date in Stockholm
+    """
+    return datetime.now(TIMEZONE).date()
+
+
+def get_menu(identifier: str, day: date = None) -> dict:
+    """
+    Get the stored menu of a restaurant
+
+    Returns None if there is no menu stored for the day (default today).
+    """
+    day = day or today()
+    row = connect().execute(
+        "SELECT data FROM menus WHERE identifier = ? AND day = ?", (identifier, day.isoformat())
+    ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def get_menu_fetched(identifier: str, day: date = None) -> float:
+    """
+    Get the time (seconds since the epoch) the stored menu of a restaurant was fetched
+
+    Returns None if there is no menu stored for the day (default today).
+    """
+    day = day or today()
+    row = connect().execute(
+        "SELECT fetched FROM menus WHERE identifier = ? AND day = ?", (identifier, day.isoformat())
+    ).fetchone()
+    return row[0] if row else None
+
+
+def put_menus(identifier: str, menus: dict):
+    """
+    Store the menus of a restaurant for several days in one transaction
+
+    Args:
+        identifier (str): The restaurant identifier.
+        menus (dict): The menu data for each day, keyed by date.
+
+    Menus of days that have passed are removed at the same time, while their dishes are
+    kept in the archive.
+    """
+    fetched = time.time()
+    conn = connect()
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR REPLACE INTO menus (identifier, day, data, fetched) VALUES (?, ?, ?, ?)",
+            [(identifier, day.isoformat(), json.dumps(data), fetched) for day, data in menus.items()],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO archive (identifier, day, dish) VALUES (?, ?, ?)",
+            [(identifier, day.isoformat(), dish) for day, data in menus.items() for dish in data["menu"]],
+        )
+        conn.execute("DELETE FROM menus WHERE day < ?", (today().isoformat(),))
+
+
+def get_page(url: str) -> dict:
+    """
+    Get the stored copy of a page, with its etag and last_modified validators
+
+    Returns None if the page has not been stored.
+    """
+    row = connect().execute(
+        "SELECT etag, last_modified, body FROM pages WHERE url = ?", (url,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"etag": row[0], "last_modified": row[1], "body": row[2]}
+
+
+def put_page(url: str, etag: str, last_modified: str, body: str):
+    """
+    Store a page together with its validators
+    """
+    connect().execute(
+        "INSERT OR REPLACE INTO pages (url, etag, last_modified, body, fetched) VALUES (?, ?, ?, ?, ?)",
+        (url, etag, last_modified, body, time.time()),
+    )
+
+
+def get_fragment(identifier: str) -> tuple:
+    """
+    Get the stored HTML of a restaurant as (hash, html)
+
+    Returns None if there is no HTML stored.
+    """
+    return connect().execute(
+        "SELECT hash, html FROM fragments WHERE identifier = ?", (identifier,)
+    ).fetchone()
+
+
+def put_fragment(identifier: str, digest: str, html: str):
+    """
+    Store the HTML of a restaurant together with the hash of the menu it shows
+    """
+    connect().execute(
+        "INSERT OR REPLACE INTO fragments (identifier, hash, html) VALUES (?, ?, ?)",
+        (identifier, digest, html),
+    )
+
+
+def get_build(path: str) -> str:
+    """
+    Get the content hash of the latest build of a page
+
+    Returns None if the page has not been built.
+    """
+    row = connect().execute("SELECT hash FROM builds WHERE path = ?", (path,)).fetchone()
+    return row[0] if row else None
+
+
+def put_build(path: str, digest: str):
+    """
+    Store the content hash of a built page
+    """
+    connect().execute("INSERT OR REPLACE INTO builds (path, hash) VALUES (?, ?)", (path, digest))
+
+
+def search_archive(terms: list, identifiers: list = None, day: date = None, limit: int = 50) -> list:
+    """
+    Find archived dishes containing all the terms (or words starting with them)
+
+    Args:
+        terms (list): The words to search for.
+        identifiers (list): Only search the dishes of these restaurants.
+        day (date): Only search the dishes of this day.
+        limit (int): The maximum number of dishes to return.
+
+    Returns the dishes as dicts with identifier, day (ISO date) and dish, newest first.
+
+    Terms shorter than 3 characters cannot be found with the trigram index, so the dishes
+    are checked for them with LIKE (anywhere in the dish) instead.
+    """
+    if not terms:
+        return []
+    indexed = [term for term in terms if len(term) >= 3]
+    if indexed:
+        sql = (
+            "SELECT archive.identifier, archive.day, archive.dish FROM archive_index"
+            " JOIN archive ON archive.rowid = archive_index.rowid WHERE archive_index MATCH ?"
+        )
+        params = [" ".join('"' + term.replace('"', '""') + '"*' for term in indexed)]
+    else:
+        sql = "SELECT archive.identifier, archive.day, archive.dish FROM archive WHERE 1"
+        params = []
+    for term in terms:
+        if len(term) < 3:
+            sql += " AND archive.dish LIKE ? ESCAPE '\\'"
+            params.append("%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    if identifiers is not None:
+        sql += f" AND archive.identifier IN ({', '.join('?' * len(identifiers))})"
+        params.extend(identifiers)
+    if day:
+        sql += " AND archive.day = ?"
+        params.append(day.isoformat())
+    sql += " ORDER BY archive.day DESC" + (", archive_index.rank" if indexed else "") + " LIMIT ?"
+    params.append(limit)
+    return [
+        {"identifier": row[0], "day": row[1], "dish": row[2]}
+        for row in connect().execute(sql, params).fetchall()
+    ]
+
+
+def get_failure(identifier: str) -> dict:
+    """
+    Get the number of failed fetches in a row for a restaurant, and when to try again
+
+    Returns None if the latest fetch succeeded.
+    """
+    row = connect().execute(
+        "SELECT count, retry_at FROM failures WHERE identifier = ?", (identifier,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"count": row[0], "retry_at": row[1]}
+
+
+def put_failure(identifier: str, count: int, retry_at: float):
+    """
+    Store the number of failed fetches in a row for a restaurant, and when to try again
+    """
+    connect().execute(
+        "INSERT OR REPLACE INTO failures (identifier, count, retry_at) VALUES (?, ?, ?)",
+        (identifier, count, retry_at),
+    )
+
+
+def clear_failure(identifier: str):
+    """
+    Forget the failed fetches of a restaurant
+    """
+    connect().execute("DELETE FROM failures WHERE identifier = ?", (identifier,))
+
+
+def get_circuit(identifier: str) -> dict:
+    """
+    Get the circuit of a restaurant: the number of errors in a row, the latest error and
+    until when the circuit is open (None if it is closed)
+
+    Returns None if the latest fetch had no error.
+    """
+    row = connect().execute(
+        "SELECT errors, error, open_until FROM circuits WHERE identifier = ?", (identifier,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"errors": row[0], "error": row[1], "open_until": row[2]}
+
+
+def get_circuits() -> dict:
+    """
+    Get the circuits of all restaurants with errors, keyed by identifier
+    """
+    rows = connect().execute("SELECT identifier, errors, error, open_until FROM circuits").fetchall()
+    return {row[0]: {"errors": row[1], "error": row[2], "open_until": row[3]} for row in rows}
+
+
+def put_circuit(identifier: str, errors: int, error: str, open_until: float = None):
+    """
+    Store the circuit of a restaurant
+    """
+    connect().execute(
+        "INSERT OR REPLACE INTO circuits (identifier, errors, error, open_until) VALUES (?, ?, ?, ?)",
+        (identifier, errors, error, open_until),
+    )
+
+
+def clear_circuit(identifier: str):
+    """
+    Close the circuit of a restaurant and forget its errors
+    """
+    connect().execute("DELETE FROM circuits WHERE identifier = ?", (identifier,))
@@ -28,6 +28,32 @@ export function getRestaurant ({ commit }, identifier) {
   });
 }
 
+// fetch the menus of all given restaurants in one request, skipping those already known
+export function getMenus ({ commit, state }, identifiers) {
+  const missing = identifiers.filter((identifier) =>
+    !(identifier in state.menus) && !state.pendingMenus.includes(identifier));
+  if (missing.length === 0) {
+    return Promise.resolve();
+  }
+  commit('addPendingMenus', missing);
+  return new Promise((resolve, reject) => {
+    axios
+      .get('/api/menus', { params: { ids: missing.join(',') } })
+      .then((response) => {
+        const found = response.data.restaurants.map((entry) => entry.identifier);
+        commit('updateMenus', response.data.restaurants);
+        commit('addFailedMenus', missing.filter((identifier) => !found.includes(identifier)));
+        commit('removePendingMenus', missing);
+        resolve(response);
+      })
+      .catch((err) => {
+        commit('addFailedMenus', missing);
+        commit('removePendingMenus', missing);
+        reject(err);
+      });
+  });
+}
+
 export function setRegion ({ commit }, value) {
   commit('updateRegion', value);
 }
@@ -2,6 +2,10 @@ export function restaurants (state) {
   return state.restaurants;
 }                  
 
+export function menus (state) {
+  return state.menus;
+}
+
 export function visibleRestaurants (state) {
   return state.visibleRestaurants;
 }                  
@@ -2,6 +2,31 @@ export function updateRestaurants (state, payload) {
   state.restaurants = payload;
 }
 
+export function updateMenus (state, payload) {
+  const menus = { ...state.menus };
+  for (const entry of payload) {
+    menus[entry.identifier] = entry;
+  }
+  state.menus = menus;
+  const found = payload.map((entry) => entry.identifier);
+  state.failedMenus = state.failedMenus.filter((identifier) => !found.includes(identifier));
+}
+
+// the menus are (re)tried, so they are no longer failed
+export function addPendingMenus (state, payload) {
+  state.pendingMenus = state.pendingMenus.concat(payload);
+  state.failedMenus = state.failedMenus.filter((identifier) => !payload.includes(identifier));
+}
+
+export function removePendingMenus (state, payload) {
+  state.pendingMenus = state.pendingMenus.filter((identifier) => !payload.includes(identifier));
+}
+
+export function addFailedMenus (state, payload) {
+  const added = payload.filter((identifier) => !state.failedMenus.includes(identifier));
+  state.failedMenus = state.failedMenus.concat(added);
+}
+
 export function updateRegion (state, payload) {
   state.currentRegion = payload;
 }
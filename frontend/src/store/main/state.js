@@ -1,6 +1,9 @@
 export default function () {
   return {
     restaurants: [],
+    menus: {},
+    pendingMenus: [],
+    failedMenus: [],
     visibleRestaurants: [],
     showMap: true,
     currentRegion: 'solna',